@@ -0,0 +1,629 @@
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Subset
+from torch.utils.data._utils.collate import default_collate
+from torch.profiler import profile, ProfilerActivity
+import torchvision.transforms.functional as TF
+from PIL import Image
+from pathlib import Path
+from time import time
+import argparse
+import random
+import json
+import os
+import io
+import platform
+import numpy as np
+from tqdm import tqdm
+
+from model import ResNet101DeepLabv3, Bottleneck
+from inference import MultiScalePredictor
+from metrics import ConfusionMatrix
+from voc2012 import VOC2012Dataset
+from samplers import InfiniteSampler
+from utils import get_device, get_grad_scaler, VOC_COLORS, N_CLASSES
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+
+    memory = subparsers.add_parser("memory")
+    memory.add_argument("--output_strides", type=int, nargs="+", required=False, default=[16, 8])
+    memory.add_argument("--img_size", type=int, required=False, default=513)
+    memory.add_argument("--batch_size", type=int, required=False, default=1)
+
+    tta = subparsers.add_parser("tta")
+    tta.add_argument("--ckpt_path", type=str, required=True)
+    tta.add_argument("--img_dir", type=str, required=True)
+    tta.add_argument("--gt_dir", type=str, required=True)
+    tta.add_argument("--n_images", type=int, required=False, default=200)
+    tta.add_argument("--n_cpus", type=int, required=False, default=4)
+    tta.add_argument("--early_exit_tol", type=float, required=False, default=0.002)
+
+    augment = subparsers.add_parser("augment")
+    augment.add_argument("--img_dir", type=str, required=True)
+    augment.add_argument("--gt_dir", type=str, required=True)
+    augment.add_argument("--n_samples", type=int, required=False, default=500)
+
+    ckpt = subparsers.add_parser("checkpoint")
+    ckpt.add_argument("--img_size", type=int, required=False, default=513)
+    ckpt.add_argument("--batch_sizes", type=int, nargs="+", required=False, default=[2, 4])
+    ckpt.add_argument("--n_steps", type=int, required=False, default=3)
+    ckpt.add_argument("--memory_budget", type=float, required=False, default=16) # In GiB
+
+    step = subparsers.add_parser("step")
+    step.add_argument("--img_size", type=int, required=False, default=513)
+    step.add_argument("--batch_size", type=int, required=False, default=4)
+    step.add_argument("--n_steps", type=int, required=False, default=20)
+
+    data = subparsers.add_parser("data")
+    # A synthetic dataset is generated in `synthetic_dir` unless `img_dir` and `gt_dir` are given.
+    data.add_argument("--img_dir", type=str, required=False)
+    data.add_argument("--gt_dir", type=str, required=False)
+    data.add_argument("--synthetic_dir", type=str, required=False, default="synthetic_voc2012")
+    data.add_argument("--n_images", type=int, required=False, default=300)
+    data.add_argument("--n_samples", type=int, required=False, default=200)
+    data.add_argument("--n_workers", type=int, nargs="+", required=False, default=[0, 2, 4, 8])
+    data.add_argument("--batch_sizes", type=int, nargs="+", required=False, default=[8, 16])
+    data.add_argument("--prefetch_factors", type=int, nargs="+", required=False, default=[2, 4])
+    data.add_argument("--n_batches", type=int, required=False, default=30)
+    data.add_argument("--save_path", type=str, required=False, default="data_benchmark.json")
+
+    args = parser.parse_args()
+
+    args_dict = vars(args)
+    new_args_dict = dict()
+    for k, v in args_dict.items():
+        new_args_dict[k.upper()] = v
+    args = argparse.Namespace(**new_args_dict)
+    return args
+
+
+def get_peak_memory(fn):
+    """
+    Returns the peak number of bytes allocated by `fn` on top of what was already allocated.
+    """
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        init_mem = torch.cuda.memory_allocated()
+        fn()
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() - init_mem
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    events = [event for event in prof.events() if event.self_cpu_memory_usage != 0]
+    events.sort(key=lambda event: event.time_range.start)
+    cur_mem = 0
+    peak_mem = 0
+    for event in events:
+        cur_mem += event.self_cpu_memory_usage
+        peak_mem = max(peak_mem, cur_mem)
+    return peak_mem
+
+
+def _clone_skip_forward(self, x):
+    """
+    The original `Bottleneck.forward`, which copied its input in every block.
+    """
+    skip = x.clone()
+    if self.downsample is not None:
+        skip = self.downsample(skip)
+
+    x = self.conv1(x)
+    x = self.bn1(x)
+    x = F.relu(x)
+    x = self.conv2(x)
+    x = self.bn2(x)
+    x = F.relu(x)
+    x = self.conv3(x)
+    x = self.bn3(x)
+
+    x = x + skip
+    x = F.relu(x)
+    return x
+
+
+def get_clone_skip_peak_memory(model, image):
+    forward = Bottleneck.forward
+    Bottleneck.forward = _clone_skip_forward
+    try:
+        return get_peak_memory(lambda: model(image))
+    finally:
+        Bottleneck.forward = forward
+
+
+def benchmark_memory(output_strides, img_size, batch_size):
+    """
+    Reports the peak activation memory of an inference forward pass with the original
+    `Bottleneck.forward` (see `_clone_skip_forward`), with the current one, and with the current
+    one on the model returned by `fuse_for_inference`.
+    """
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    image = torch.randn(batch_size, 3, img_size, img_size, device=device)
+    for output_stride in output_strides:
+        model = ResNet101DeepLabv3(output_stride=output_stride, pretrained_backbone=False)
+        model = model.to(device).eval()
+        fused_model = model.fuse_for_inference()
+        with torch.inference_mode():
+            clone_peak_mem = get_clone_skip_peak_memory(model, image)
+            peak_mem = get_peak_memory(lambda: model(image))
+            fused_peak_mem = get_peak_memory(lambda: fused_model(image))
+        log = f"[ Output stride: {output_stride} ][ Input: {tuple(image.shape)} ]"
+        log += f"[ Peak activation memory: {clone_peak_mem / 2 ** 20:,.1f}MiB (with copy)"
+        log += f" | {peak_mem / 2 ** 20:,.1f}MiB"
+        log += f" | {fused_peak_mem / 2 ** 20:,.1f}MiB (fused, in-place) ]"
+        print(log)
+
+
+def benchmark_tta(ckpt_path, img_dir, gt_dir, n_images, n_cpus, early_exit_tol):
+    """
+    Reports the mIoU and the latency of each test-time augmentation setting, and the extra latency
+    paid per mIoU point gained over single-scale inference.
+    """
+    device = get_device()
+    model = ResNet101DeepLabv3.from_checkpoint(ckpt_path, output_stride=16, device=device)
+    model.eval()
+
+    val_ds = VOC2012Dataset(img_dir=img_dir, gt_dir=gt_dir, split="val")
+    val_ds = Subset(val_ds, indices=range(min(n_images, len(val_ds))))
+    val_dl = DataLoader(val_ds, batch_size=1, shuffle=False, num_workers=n_cpus)
+
+    ms_scales = (0.5, 0.75, 1.0, 1.25, 1.5, 1.75)
+    settings = {
+        "Single scale": dict(scales=(1.0,), flip=False),
+        "Flip": dict(scales=(1.0,), flip=True),
+        "Multi-scale": dict(scales=ms_scales, flip=False),
+        "Multi-scale + flip": dict(scales=ms_scales, flip=True),
+        "Multi-scale + flip (early exit)": dict(scales=ms_scales, flip=True, early_exit_tol=early_exit_tol),
+    }
+    base_miou = None
+    base_latency = None
+    for name, kwargs in settings.items():
+        predictor = MultiScalePredictor(model=model, **kwargs)
+        conf_mat = ConfusionMatrix(device=device)
+        elapsed = 0
+        cum_n_scales = 0
+        for image, gt in val_dl:
+            image = image.to(device)
+            gt = gt.to(device)
+
+            start_time = time()
+            pred, n_scales = predictor.predict(image)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            elapsed += time() - start_time
+            cum_n_scales += n_scales
+            conf_mat.update(pred=pred, gt=gt)
+        miou = conf_mat.get_scores()["miou"]
+        latency = elapsed / len(val_ds)
+
+        log = f"[ {name} ][ mIoU: {miou:.4f} ][ Latency: {latency * 1000:,.1f}ms/image ]"
+        log += f"[ Scales run: {cum_n_scales / len(val_ds):.2f} ]"
+        if base_miou is None:
+            base_miou = miou
+            base_latency = latency
+        elif miou > base_miou:
+            cost = (latency - base_latency) / ((miou - base_miou) * 100)
+            log += f"[ +{cost * 1000:,.1f}ms/image per mIoU point ]"
+        print(log)
+
+
+def benchmark_augment(img_dir, gt_dir, n_samples):
+    """
+    Compares the fused train augmentation of `VOC2012Transform` with the sequential one, and with
+    reduced-resolution JPEG decoding: samples/sec in a single process (i.e., per `DataLoader`
+    worker) and, as a distributional equivalence check, the per-channel moments of the output
+    images, the fraction of padded pixels and the class frequencies of the output ground truths.
+    The distributions of the scale, flip and crop are asserted to match in
+    `tests/test_voc2012.py`.
+    """
+    settings = {
+        "Sequential": dict(fused_aug=False, draft_decode=False),
+        "Fused": dict(fused_aug=True, draft_decode=False),
+        "Fused + draft decode": dict(fused_aug=True, draft_decode=True),
+    }
+    stats = dict()
+    for name, kwargs in settings.items():
+        ds = VOC2012Dataset(img_dir=img_dir, gt_dir=gt_dir, split="train", **kwargs)
+        random.seed(0)
+        torch.manual_seed(0)
+        indices = [random.randrange(len(ds)) for _ in range(n_samples)]
+
+        mean = torch.tensor(ds.mean)[:, None, None]
+        std = torch.tensor(ds.std)[:, None, None]
+        sum_rgb = 0
+        sum_rgb_square = 0
+        n_pixels = 0
+        n_pad_pixels = 0
+        cls_cnts = 0
+        elapsed = 0
+        for idx in indices:
+            start_time = time()
+            image, gt = ds[idx]
+            elapsed += time() - start_time
+
+            image = image * std + mean
+            sum_rgb += image.sum(dim=(1, 2)).double()
+            sum_rgb_square += (image ** 2).sum(dim=(1, 2)).double()
+            n_pixels += image[0].numel()
+            n_pad_pixels += (image.abs().sum(dim=0) < 1e-6).sum().item()
+            cls_cnts += torch.bincount(gt.flatten(), minlength=256).double()
+        img_mean = sum_rgb / n_pixels
+        stats[name] = {
+            "img_mean": img_mean,
+            "img_std": (sum_rgb_square / n_pixels - img_mean ** 2) ** 0.5,
+            "pad_ratio": n_pad_pixels / n_pixels,
+            "cls_freq": cls_cnts / cls_cnts.sum(),
+        }
+
+        log = f"[ {name} ][ {n_samples / elapsed:,.1f} samples/sec ]"
+        log += f"[ Image mean: {[round(i, 4) for i in stats[name]['img_mean'].tolist()]} ]"
+        log += f"[ Image std: {[round(i, 4) for i in stats[name]['img_std'].tolist()]} ]"
+        log += f"[ Padded pixels: {stats[name]['pad_ratio']:.4f} ]"
+        print(log)
+    for name in list(settings)[1:]:
+        cls_freq_diff = (stats[name]["cls_freq"] - stats["Sequential"]["cls_freq"]).abs().max().item()
+        print(f"[ {name} ][ Maximum difference in class frequency from sequential: {cls_freq_diff:.4f} ]")
+
+
+def benchmark_checkpoint(img_size, batch_sizes, n_steps, memory_budget):
+    """
+    Reports, at `output_stride = 8`, the peak memory and the duration of a training step (forward
+    and backward) for several settings of `ResNet101DeepLabv3.set_activation_checkpointing`, and
+    the largest batch size which fits in `memory_budget` GiB. The latter is extrapolated linearly
+    from the two largest batch sizes measured, adding the weights and the two AdamW moments.
+    """
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    settings = {
+        "None": dict(),
+        "Block3 (4 segments)": dict(block3_segments=4),
+        "Block3 (4 segments), block4, ASPP": dict(block3_segments=4, block4_segments=3, aspp=True),
+        "Block3 (23 segments), block4, ASPP": dict(block3_segments=23, block4_segments=3, aspp=True),
+    }
+    for name, kwargs in settings.items():
+        model = ResNet101DeepLabv3(output_stride=8, pretrained_backbone=False).to(device).train()
+        model.set_activation_checkpointing(**kwargs)
+        param_mem = sum([param.numel() * param.element_size() for param in model.parameters()])
+
+        peak_mems = list()
+        for batch_size in batch_sizes:
+            image = torch.randn(batch_size, 3, img_size, img_size, device=device)
+            gt = torch.randint(0, 21, size=(batch_size, 1, img_size, img_size), device=device)
+
+            def train_step():
+                model.get_loss(image=image, gt=gt).backward()
+                model.zero_grad(set_to_none=True)
+
+            train_step()
+            peak_mem = get_peak_memory(train_step)
+            peak_mems.append(peak_mem)
+
+            start_time = time()
+            for _ in range(n_steps):
+                train_step()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            elapsed = (time() - start_time) / n_steps
+
+            log = f"[ {name} ][ Batch size: {batch_size} ]"
+            log += f"[ Peak memory: {peak_mem / 2 ** 30:,.2f}GiB ][ {elapsed:,.2f}s/step ]"
+            print(log)
+
+        if len(batch_sizes) >= 2:
+            (b1, m1), (b2, m2) = sorted(zip(batch_sizes, peak_mems))[-2:]
+            mem_per_sample = (m2 - m1) / (b2 - b1)
+            fixed_mem = m1 - mem_per_sample * b1 + 3 * param_mem
+            max_batch_size = int((memory_budget * 2 ** 30 - fixed_mem) // mem_per_sample)
+            log = f"[ {name} ][ {mem_per_sample / 2 ** 30:,.2f}GiB/sample ]"
+            log += f"[ Largest batch size in {memory_budget:g}GiB: {max(max_batch_size, 0)} ]"
+            print(log)
+
+
+def benchmark_step(img_size, batch_size, n_steps):
+    """
+    Compares the duration of `Trainer.train_for_one_step` when the host waits for the loss after
+    every step (`loss.item()`) with when it does not, and with a non-blocking copy of the pinned
+    batch to the device. Without a GPU, the steps are synchronous anyway and the settings should
+    be on a par.
+    """
+    # Imported here so that the other modes do not load `train.py`.
+    from train import Trainer
+
+    device = get_device()
+    model = ResNet101DeepLabv3(output_stride=16, pretrained_backbone=False).to(device).train()
+    optim = torch.optim.SGD(model.parameters(), lr=1e-4)
+    scaler = get_grad_scaler(device=device)
+
+    image = torch.randn(batch_size, 3, img_size, img_size)
+    gt = torch.randint(0, 21, size=(batch_size, 1, img_size, img_size))
+    if device.type == "cuda":
+        image = image.pin_memory()
+        gt = gt.pin_memory()
+
+    settings = {
+        "Sync every step": dict(sync=True, non_blocking=False),
+        "Deferred sync": dict(sync=False, non_blocking=False),
+        "Deferred sync + non-blocking copy": dict(sync=False, non_blocking=True),
+    }
+    for name, kwargs in settings.items():
+        trainer = Trainer(
+            train_dl=None,
+            val_dl=None,
+            save_dir=".",
+            init_lr=1e-4,
+            n_steps=n_steps + 1,
+            device=device,
+            non_blocking=kwargs["non_blocking"],
+        )
+
+        def run_step(step):
+            loss = trainer.train_for_one_step(
+                batches=[(image, gt)], step=step, model=model, optim=optim, scaler=scaler,
+            )
+            if kwargs["sync"]:
+                loss.item()
+
+        run_step(step=0)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start_time = time()
+        for step in range(n_steps):
+            run_step(step=step)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = (time() - start_time) / n_steps
+        print(f"[ {name} ][ {elapsed * 1000:,.1f}ms/step ]")
+
+
+def make_synthetic_voc(root, n_images=300, val_ratio=0.1, seed=0):
+    """
+    Writes `n_images` random image-ground truth pairs in the layout of VOC 2012 and
+    'SegmentationClassAug' (JPEGs and palette PNGs of the usual VOC sizes, a few objects with
+    'void' borders each) and returns the `img_dir` and the `gt_dir`.
+    """
+    root = Path(root)
+    img_dir = root/"VOC2012/JPEGImages"
+    gt_dir = root/"SegmentationClassAug"
+    img_dir.mkdir(parents=True, exist_ok=True)
+    gt_dir.mkdir(parents=True, exist_ok=True)
+    (root/"VOC2012/ImageSets/Segmentation").mkdir(parents=True, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    # `VOC_COLORS` ends with the color of 'GRID', which is not a class.
+    palette = sum(VOC_COLORS[: N_CLASSES], ()) + (224, 224, 192) * (256 - N_CLASSES)
+    stems = [f"2012_{idx:06d}" for idx in range(n_images)]
+    for stem in tqdm(stems, desc="Generating synthetic dataset..."):
+        w, h = [(500, 375), (375, 500), (500, 333), (500, 500)][rng.integers(4)]
+        # Smooth colors compress like natural images, unlike white noise.
+        image = Image.fromarray(rng.integers(0, 256, size=(h // 16, w // 16, 3), dtype=np.uint8))
+        image = image.resize((w, h), resample=Image.BICUBIC)
+        image.save(img_dir/f"{stem}.jpg", quality=90)
+
+        gt = np.zeros((h, w), dtype=np.uint8)
+        for _ in range(rng.integers(1, 4)):
+            y0, x0 = rng.integers(0, h - 50), rng.integers(0, w - 50)
+            y1, x1 = y0 + rng.integers(40, h - y0 + 1), x0 + rng.integers(40, w - x0 + 1)
+            gt[y0: y1, x0: x1] = 255
+            gt[y0 + 3: y1 - 3, x0 + 3: x1 - 3] = rng.integers(1, N_CLASSES)
+        gt = Image.fromarray(gt, mode="P")
+        gt.putpalette(palette)
+        gt.save(gt_dir/f"{stem}.png")
+
+    with open(root/"VOC2012/ImageSets/Segmentation/val.txt", mode="w") as f:
+        f.write("\n".join(stems[: round(n_images * val_ratio)]) + "\n")
+    return img_dir, gt_dir
+
+
+def profile_data_stages(ds, n_samples, batch_size, n_warmup=5):
+    """
+    Times each stage of the train preprocessing of `ds` (sequential or fused, see
+    `VOC2012Transform._transform`) in the main process, in ms/sample. The first `n_warmup`
+    samples are left out.
+    """
+    stages = dict()
+
+    def timed(name, fn, *args, **kwargs):
+        start_time = time()
+        out = fn(*args, **kwargs)
+        stages[name] = stages.get(name, 0) + time() - start_time
+        return out
+
+    def read_files(idx):
+        gt_path = ds.gts[idx]
+        with open(f"{ds.img_dir/gt_path.stem}.jpg", mode="rb") as f:
+            img_bytes = f.read()
+        with open(gt_path, mode="rb") as f:
+            gt_bytes = f.read()
+        return Image.open(io.BytesIO(img_bytes)), Image.open(io.BytesIO(gt_bytes))
+
+    samples = list()
+    for idx in range(n_warmup + n_samples):
+        if idx == n_warmup:
+            stages.clear()
+            samples.clear()
+        image, gt = timed("open", read_files, random.randrange(len(ds)))
+        timed("decode", gt.load)
+        if ds.fused_aug:
+            w, h = gt.size
+            scaled_size, corner, flip = ds._get_scale_flip_and_crop_params(w=w, h=h)
+            image = timed("decode", ds._decode, image, size=scaled_size)
+            image = timed(
+                "scale_flip_and_crop",
+                ds._scale_flip_and_crop,
+                image,
+                scaled_size=scaled_size,
+                corner=corner,
+                flip=flip,
+                resample=Image.BILINEAR,
+            )
+            gt = timed(
+                "scale_flip_and_crop",
+                ds._scale_flip_and_crop,
+                gt,
+                scaled_size=scaled_size,
+                corner=corner,
+                flip=flip,
+                resample=Image.NEAREST,
+            )
+            image = timed("adjust_b_and_s", ds._randomly_adjust_b_and_s, image)
+        else:
+            image = timed("decode", ds._decode, image)
+            image = timed("adjust_b_and_s", ds._randomly_adjust_b_and_s, image)
+            image, gt = timed("flip", ds._randomly_flip_horizontally, image=image, gt=gt)
+            image, gt = timed("scale", ds._randomly_scale, image=image, gt=gt)
+            image, gt = timed("crop", ds._randomly_crop, image=image, gt=gt)
+        image = timed("to_tensor", TF.to_tensor, image)
+        image = timed("normalize", TF.normalize, image, mean=ds.mean, std=ds.std)
+        gt = timed("to_tensor", lambda x: TF.pil_to_tensor(x).long(), gt)
+        samples.append((image, gt))
+
+    n_batches = 0
+    for idx in range(0, len(samples) - batch_size + 1, batch_size):
+        batch = timed("collate", default_collate, samples[idx: idx + batch_size])
+        if torch.cuda.is_available():
+            timed("pin", lambda x: [i.pin_memory() for i in x], batch)
+        n_batches += 1
+    # The per-batch stages are spread over the samples of the batches.
+    for name in ["collate", "pin"]:
+        if name in stages:
+            stages[name] /= n_batches * batch_size / n_samples
+    return {name: elapsed / n_samples * 1000 for name, elapsed in stages.items()}
+
+
+def measure_data_throughput(ds, n_workers, batch_size, prefetch_factor, n_batches):
+    """
+    Returns the samples/sec that a `DataLoader` set up as in `train.py` delivers to the training
+    loop, leaving out the first batch, which includes starting the workers.
+    """
+    dl = DataLoader(
+        ds,
+        batch_size=batch_size,
+        sampler=InfiniteSampler(len(ds)),
+        pin_memory=torch.cuda.is_available(),
+        num_workers=n_workers,
+        prefetch_factor=prefetch_factor if n_workers > 0 else None,
+    )
+    di = iter(dl)
+    next(di)
+    start_time = time()
+    for _ in range(n_batches):
+        next(di)
+    elapsed = time() - start_time
+    del di
+    return n_batches * batch_size / elapsed
+
+
+def benchmark_data(
+    img_dir,
+    gt_dir,
+    synthetic_dir,
+    n_images,
+    n_samples,
+    n_workers,
+    batch_sizes,
+    prefetch_factors,
+    n_batches,
+    save_path,
+):
+    """
+    Measures whether the training could be input-bound: the cost of each preprocessing stage and
+    the throughput of the train `DataLoader` across numbers of workers, batch sizes and prefetch
+    factors. The results are also written to `save_path` as JSON, to be compared across commits.
+    """
+    if img_dir is None or gt_dir is None:
+        img_dir, gt_dir = make_synthetic_voc(synthetic_dir, n_images=n_images)
+
+    report = {
+        "environment": {
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "n_cpus": os.cpu_count(),
+            "cuda": torch.cuda.is_available(),
+        },
+        "dataset": {"img_dir": str(img_dir), "gt_dir": str(gt_dir)},
+        "stages": dict(),
+        "throughput": list(),
+    }
+    for fused_aug in [False, True]:
+        ds = VOC2012Dataset(img_dir=img_dir, gt_dir=gt_dir, split="train", fused_aug=fused_aug)
+        name = "fused" if fused_aug else "sequential"
+        stages = profile_data_stages(ds, n_samples=n_samples, batch_size=max(batch_sizes))
+        report["stages"][name] = stages
+        report["dataset"]["n_samples"] = len(ds)
+
+        log = f"[ {name.capitalize()} ][ Total: {sum(stages.values()):,.2f}ms/sample ]"
+        log += "".join([f"[ {k}: {v:,.2f}ms ]" for k, v in stages.items()])
+        print(log)
+
+    ds = VOC2012Dataset(img_dir=img_dir, gt_dir=gt_dir, split="train")
+    for n_worker in n_workers:
+        for batch_size in batch_sizes:
+            # The prefetch factor only applies to worker processes.
+            for prefetch_factor in (prefetch_factors if n_worker > 0 else [None]):
+                samples_per_sec = measure_data_throughput(
+                    ds,
+                    n_workers=n_worker,
+                    batch_size=batch_size,
+                    prefetch_factor=prefetch_factor,
+                    n_batches=n_batches,
+                )
+                report["throughput"].append(
+                    {
+                        "n_workers": n_worker,
+                        "batch_size": batch_size,
+                        "prefetch_factor": prefetch_factor,
+                        "samples_per_sec": samples_per_sec,
+                    }
+                )
+                log = f"[ Workers: {n_worker} ][ Batch size: {batch_size} ]"
+                log += f"[ Prefetch factor: {prefetch_factor} ][ {samples_per_sec:,.1f} samples/sec ]"
+                print(log)
+
+    Path(save_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(save_path, mode="w") as f:
+        json.dump(report, f, indent=4)
+    print(f"[ Report saved to '{save_path}'. ]")
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.MODE == "memory":
+        benchmark_memory(
+            output_strides=args.OUTPUT_STRIDES, img_size=args.IMG_SIZE, batch_size=args.BATCH_SIZE,
+        )
+    elif args.MODE == "tta":
+        benchmark_tta(
+            ckpt_path=args.CKPT_PATH,
+            img_dir=args.IMG_DIR,
+            gt_dir=args.GT_DIR,
+            n_images=args.N_IMAGES,
+            n_cpus=args.N_CPUS,
+            early_exit_tol=args.EARLY_EXIT_TOL,
+        )
+    elif args.MODE == "augment":
+        benchmark_augment(img_dir=args.IMG_DIR, gt_dir=args.GT_DIR, n_samples=args.N_SAMPLES)
+    elif args.MODE == "checkpoint":
+        benchmark_checkpoint(
+            img_size=args.IMG_SIZE,
+            batch_sizes=args.BATCH_SIZES,
+            n_steps=args.N_STEPS,
+            memory_budget=args.MEMORY_BUDGET,
+        )
+    elif args.MODE == "step":
+        benchmark_step(img_size=args.IMG_SIZE, batch_size=args.BATCH_SIZE, n_steps=args.N_STEPS)
+    elif args.MODE == "data":
+        benchmark_data(
+            img_dir=args.IMG_DIR,
+            gt_dir=args.GT_DIR,
+            synthetic_dir=args.SYNTHETIC_DIR,
+            n_images=args.N_IMAGES,
+            n_samples=args.N_SAMPLES,
+            n_workers=args.N_WORKERS,
+            batch_sizes=args.BATCH_SIZES,
+            prefetch_factors=args.PREFETCH_FACTORS,
+            n_batches=args.N_BATCHES,
+            save_path=args.SAVE_PATH,
+        )
@@ -0,0 +1,247 @@
+import torch
+import torch.nn.functional as F
+import torchvision.transforms.functional as TF
+from PIL import Image
+import argparse
+import math
+
+from model import ResNet101DeepLabv3
+from utils import VOC_COLORS, VOC_MEAN, VOC_STD, get_device
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--ckpt_path", type=str, required=True)
+    # The checkpoints of either stage can be evaluated at either output stride.
+    parser.add_argument("--output_stride", type=int, required=False, default=16, choices=[16, 8])
+    parser.add_argument("--img_path", type=str, required=True)
+    parser.add_argument("--save_path", type=str, required=True)
+    parser.add_argument("--tile_size", type=int, required=False, default=513)
+    parser.add_argument("--overlap", type=float, required=False, default=1 / 3)
+    parser.add_argument(
+        "--blending",
+        type=str,
+        required=False,
+        default="gaussian",
+        choices=["gaussian", "linear", "constant"],
+    )
+    parser.add_argument("--batch_size", type=int, required=False, default=2)
+
+    args = parser.parse_args()
+
+    args_dict = vars(args)
+    new_args_dict = dict()
+    for k, v in args_dict.items():
+        new_args_dict[k.upper()] = v
+    args = argparse.Namespace(**new_args_dict)
+    return args
+
+
+class TiledPredictor(object):
+    """
+    Segments images of any size by running the model on overlapping `tile_size × tile_size` tiles
+    and blending their logits.
+
+    The tiles are processed one row of tiles at a time and the rows of the output which no later
+    tile can overlap are reduced to labels right away, so besides the input image and the output
+    labels, the memory in use is bounded by `batch_size` tiles going through the model and a
+    `(n_classes, tile_size, w)` accumulator, whatever the height of the image. The bound is set
+    through `tile_size` and `batch_size`, not as a number of bytes: `benchmark.py memory` gives the
+    peak memory of the model for a given input size.
+    """
+    def __init__(self, model, tile_size=513, overlap=1 / 3, blending="gaussian", batch_size=2):
+        if tile_size < 1:
+            raise ValueError(f"`tile_size` must be at least 1, got {tile_size}.")
+        if not 0 <= overlap < 1:
+            raise ValueError(f"`overlap` must be in [0, 1), got {overlap}.")
+        if batch_size < 1:
+            raise ValueError(f"`batch_size` must be at least 1, got {batch_size}.")
+
+        self.model = model
+        self.tile_size = tile_size
+        self.stride = math.ceil(tile_size * (1 - overlap))
+        self.batch_size = batch_size
+
+        self.weight_map = self.get_weight_map(tile_size=tile_size, blending=blending)
+
+    @staticmethod
+    def get_weight_map(tile_size, blending):
+        """
+        Returns a `(tile_size, tile_size)` map of strictly positive weights which decrease towards
+        the borders of the tile, where the receptive field is truncated.
+        """
+        coord = torch.arange(tile_size, dtype=torch.float32)
+        if blending == "gaussian":
+            sigma = tile_size / 8
+            weight = torch.exp(-((coord - (tile_size - 1) / 2) ** 2) / (2 * sigma ** 2))
+        elif blending == "linear":
+            weight = torch.minimum(coord + 1, tile_size - coord) / math.ceil(tile_size / 2)
+        elif blending == "constant":
+            weight = torch.ones(tile_size)
+        else:
+            raise ValueError(f"Unknown blending '{blending}'.")
+        weight = weight.clamp(min=1e-3)
+        return weight[:, None] * weight[None, :]
+
+    def _get_starts(self, size):
+        if size <= self.tile_size:
+            return [0]
+        starts = list(range(0, size - self.tile_size, self.stride))
+        starts.append(size - self.tile_size)
+        return starts
+
+    def _add_tiles(self, image, acc, y, xs, weight_map):
+        for idx in range(0, len(xs), self.batch_size):
+            batch_xs = xs[idx: idx + self.batch_size]
+            tiles = torch.stack(
+                [image[:, y: y + self.tile_size, x: x + self.tile_size] for x in batch_xs],
+            )
+            logits = self.model(tiles) # `(b, n_classes, tile_size, tile_size)`
+            for x, logit in zip(batch_xs, logits):
+                acc[:, :, x: x + self.tile_size] += logit * weight_map
+
+    @torch.inference_mode()
+    def predict(self, image):
+        """
+        Args:
+            image: `(3, h, w)`, normalized
+        Returns:
+            `(h, w)` label map (dtype: `torch.uint8`)
+        """
+        _, ori_h, ori_w = image.shape
+        # Padding with zeros is padding with the mean color after normalization, as in
+        # `VOC2012Dataset.get_val_transform`.
+        image = F.pad(
+            image, pad=(0, max(0, self.tile_size - ori_w), 0, max(0, self.tile_size - ori_h)),
+        )
+        _, h, w = image.shape
+        device = next(self.model.parameters()).device
+        image = image.to(device)
+        weight_map = self.weight_map.to(device)
+
+        labels = torch.empty((h, w), dtype=torch.uint8, device=device)
+        acc = torch.zeros(
+            (self.model.fin_conv.out_channels, self.tile_size, w), dtype=torch.float32, device=device,
+        )
+        top = 0
+        xs = self._get_starts(w)
+        for y in self._get_starts(h):
+            # Rows above `y` are not covered by any later tile. Since the weights are
+            # positive, the argmax of the weighted sum is that of the weighted average.
+            shift = y - top
+            if shift > 0:
+                labels[top: y] = torch.argmax(acc[:, : shift], dim=0)
+                acc[:, : self.tile_size - shift] = acc[:, shift:].clone()
+                acc[:, self.tile_size - shift:] = 0
+                top = y
+
+            self._add_tiles(image=image, acc=acc, y=y, xs=xs, weight_map=weight_map)
+        labels[top:] = torch.argmax(acc[:, : h - top], dim=0)
+        return labels[: ori_h, : ori_w]
+
+
+class MultiScalePredictor(object):
+    """
+    Test-time augmentation with multi-scale inputs and left-right flipped inputs, whose logits
+    are averaged, as for the paper's best results on PASCAL VOC 2012.
+
+    The flipped copies go through the model in the same batch as the original images, the scales
+    are run from the most to the least expensive and the logits are accumulated in a single
+    buffer at the input resolution. As in `ResNet101DeepLabv3.predict_labels`, the logits of each
+    scale are upsampled separably and added to the buffer `chunk_size` rows at a time, so no other
+    tensor at the input resolution is allocated. If `early_exit_tol` is given, the remaining
+    scales are skipped as soon as adding a scale changes the argmax of less than that fraction of
+    the pixels.
+    """
+    def __init__(
+        self,
+        model,
+        scales=(0.5, 0.75, 1.0, 1.25, 1.5, 1.75),
+        flip=True,
+        early_exit_tol=None,
+        chunk_size=64,
+    ):
+        self.model = model
+        self.scales = sorted(scales, reverse=True)
+        self.flip = flip
+        self.early_exit_tol = early_exit_tol
+        self.chunk_size = chunk_size
+
+    def _accumulate(self, acc, logits):
+        """
+        Adds `logits` bilinearly upsampled (with `align_corners=True`) to `acc`.
+        """
+        _, _, h, w = acc.shape
+        _, _, low_h, _ = logits.shape
+        # Upsample horizontally only, then interpolate between rows chunk by chunk.
+        logits = F.interpolate(logits, size=(low_h, w), mode="bilinear", align_corners=True)
+        src_y = torch.arange(h, device=acc.device, dtype=acc.dtype) * ((low_h - 1) / max(h - 1, 1))
+        top = src_y.floor().long()
+        bottom = (top + 1).clamp(max=low_h - 1)
+        frac = (src_y - top)[:, None]
+        for start in range(0, h, self.chunk_size):
+            end = min(start + self.chunk_size, h)
+            acc[:, :, start: end] += torch.lerp(
+                logits[:, :, top[start: end]], logits[:, :, bottom[start: end]], frac[start: end],
+            )
+
+    @torch.inference_mode()
+    def predict(self, image):
+        """
+        Args:
+            image: `(b, 3, h, w)`, normalized
+        Returns:
+            `(b, 1, h, w)` label maps (dtype: `torch.uint8`) and the number of scales run
+        """
+        b, _, h, w = image.shape
+        acc = torch.zeros(
+            (b, self.model.fin_conv.out_channels, h, w), dtype=torch.float32, device=image.device,
+        )
+        argmax = None
+        for n_scales, scale in enumerate(self.scales, start=1):
+            size = (round(h * scale), round(w * scale))
+            x = F.interpolate(image, size=size, mode="bilinear", align_corners=True)
+            if self.flip:
+                x = torch.cat([x, x.flip(-1)], dim=0)
+            logits = self.model.get_logits(x).float()
+            if self.flip:
+                # The upsampling commutes with the flip, so the flipped logits are added at the
+                # low resolution.
+                logits = logits[: b] + logits[b:].flip(-1)
+            self._accumulate(acc, logits)
+
+            if self.early_exit_tol is not None:
+                new_argmax = torch.argmax(acc, dim=1, keepdim=True)
+                if argmax is not None:
+                    changed = (new_argmax != argmax).float().mean().item()
+                    if changed < self.early_exit_tol:
+                        break
+                argmax = new_argmax
+        return torch.argmax(acc, dim=1, keepdim=True).byte(), n_scales
+
+
+if __name__ == "__main__":
+    args = get_args()
+    DEVICE = get_device()
+
+    model = ResNet101DeepLabv3.from_checkpoint(
+        args.CKPT_PATH, output_stride=args.OUTPUT_STRIDE, device=DEVICE,
+    )
+    model.eval()
+    predictor = TiledPredictor(
+        model=model,
+        tile_size=args.TILE_SIZE,
+        overlap=args.OVERLAP,
+        blending=args.BLENDING,
+        batch_size=args.BATCH_SIZE,
+    )
+
+    image = Image.open(args.IMG_PATH).convert("RGB")
+    image = TF.to_tensor(image)
+    image = TF.normalize(image, mean=VOC_MEAN, std=VOC_STD)
+    labels = predictor.predict(image)
+
+    pred = Image.fromarray(labels.cpu().numpy(), mode="P")
+    pred.putpalette(sum(VOC_COLORS, ()))
+    pred.save(args.SAVE_PATH)
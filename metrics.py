@@ -0,0 +1,69 @@
+# References:
+    # https://github.com/pytorch/vision/blob/main/references/segmentation/utils.py
+
+import torch
+import torch.distributed as dist
+
+from utils import VOC_CLASSES
+
+
+class ConfusionMatrix(object):
+    """
+    "The performance is measured in terms of pixel intersection-over-union (IOU) averaged
+        across the 21 classes."
+
+    Accumulates a `(n_classes, n_classes)` confusion matrix (rows: ground truth, columns: prediction)
+    over the whole dataset, so the scores are computed at the dataset level rather than averaged
+    over batches.
+    """
+    def __init__(self, n_classes=len(VOC_CLASSES), ignore_index=255, device="cpu"):
+        self.n_classes = n_classes
+        self.ignore_index = ignore_index
+        self.mat = torch.zeros((n_classes, n_classes), dtype=torch.int64, device=device)
+
+    def reset(self):
+        self.mat.zero_()
+
+    @torch.inference_mode()
+    def update(self, pred, gt):
+        """
+        Args:
+            pred: `(b, n_classes, h, w)` logits or `(b, 1, h, w)` labels
+            gt: `(b, 1, h, w)`
+        """
+        if pred.ndim == 4 and pred.size(1) != 1:
+            pred = torch.argmax(pred, dim=1, keepdim=True)
+        pred = pred.flatten()
+        gt = gt.flatten()
+        # Any other label outside `[0, n_classes)` would land in the bins of another class.
+        valid = (gt != self.ignore_index) & (gt >= 0) & (gt < self.n_classes)
+        valid &= (pred >= 0) & (pred < self.n_classes)
+        # Invalid pixels are sent to an extra bin which is dropped afterwards, so that no boolean
+        # indexing (and thus no device sync) is needed.
+        idx = torch.where(valid, gt * self.n_classes + pred, self.n_classes ** 2)
+        self.mat += torch.bincount(
+            idx, minlength=self.n_classes ** 2 + 1,
+        )[: -1].view(self.n_classes, self.n_classes)
+
+    def all_reduce(self):
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.mat, op=dist.ReduceOp.SUM)
+
+    def get_scores(self):
+        mat = self.mat.double().cpu()
+        tp = torch.diag(mat)
+        n_gt = mat.sum(dim=1)
+        n_pred = mat.sum(dim=0)
+        union = n_gt + n_pred - tp
+        # Classes which appear neither in the ground truth nor in the prediction are left out.
+        iou = tp / union
+        present = (union > 0)
+        freq = n_gt / n_gt.sum()
+        return {
+            "iou_by_cls": {
+                c: round(iou[idx].item(), 4) for idx, c in enumerate(VOC_CLASSES[: self.n_classes]) if present[idx]
+            },
+            "miou": iou[present].mean().item(),
+            "pixel_acc": (tp.sum() / mat.sum()).item(),
+            "fw_iou": (freq[present] * iou[present]).sum().item(),
+        }
@@ -5,15 +5,108 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.utils.checkpoint import checkpoint
 from torchvision.models import resnet101, ResNet101_Weights
 import einops
 import ssl
+import copy
+import math
+import re
+import contextlib
+from collections import OrderedDict
 
-from utils import VOC_CLASSES
+from utils import modify_state_dict
 
 ssl._create_default_https_context = ssl._create_unverified_context
 
 
+@contextlib.contextmanager
+def _freeze_bn_stats(module):
+    """
+    Keeps the batch normalization layers of `module` from updating their running statistics,
+    while still normalizing with the batch statistics in training mode.
+    """
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    states = [
+        (bn.momentum, None if bn.num_batches_tracked is None else bn.num_batches_tracked.clone())
+        for bn in bns
+    ]
+    for bn in bns:
+        bn.momentum = 0.0
+    try:
+        yield
+    finally:
+        for bn, (momentum, num_batches_tracked) in zip(bns, states):
+            bn.momentum = momentum
+            if num_batches_tracked is not None:
+                bn.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def checkpoint_module(fn, module, *args):
+    """
+    Runs `fn(*args)`, which applies `module`, without keeping its intermediate activations for
+    the backward pass, where they are recomputed. The recomputation runs with the running
+    statistics of the batch normalization layers in `module` frozen, so that they are updated
+    once per forward pass as without checkpointing.
+    """
+    return checkpoint(
+        fn,
+        *args,
+        use_reentrant=False,
+        context_fn=lambda: (contextlib.nullcontext(), _freeze_bn_stats(module)),
+    )
+
+
+def checkpoint_sequential(layers, x, n_segments):
+    """
+    Applies the `nn.Sequential` `layers` to `x` in `n_segments` contiguous segments checkpointed
+    with `checkpoint_module`, so only the inputs of the segments are kept for the backward pass.
+    `n_segments=0` disables checkpointing.
+    """
+    if n_segments == 0 or not torch.is_grad_enabled():
+        return layers(x)
+
+    size = math.ceil(len(layers) / n_segments)
+    for start in range(0, len(layers), size):
+        segment = layers[start: start + size]
+        x = checkpoint_module(segment, segment, x)
+    return x
+
+
+class FrozenBatchNorm2d(nn.Module):
+    """
+    Batch normalization with fixed statistics and affine parameters, applied as a per-channel
+    scale and shift. Unlike `nn.BatchNorm2d` in training mode, it does not keep its input for the
+    backward pass. It has the same state dict as `nn.BatchNorm2d`, so checkpoints are
+    interchangeable.
+    """
+    def __init__(self, n_features, eps=1e-5):
+        super().__init__()
+
+        self.eps = eps
+        self.register_buffer("weight", torch.ones(n_features))
+        self.register_buffer("bias", torch.zeros(n_features))
+        self.register_buffer("running_mean", torch.zeros(n_features))
+        self.register_buffer("running_var", torch.ones(n_features))
+        self.register_buffer("num_batches_tracked", torch.tensor(0, dtype=torch.long))
+
+    @classmethod
+    def from_batchnorm(cls, bn):
+        frozen_bn = cls(bn.num_features, eps=bn.eps).to(bn.running_mean.device)
+        frozen_bn.weight.copy_(bn.weight.detach())
+        frozen_bn.bias.copy_(bn.bias.detach())
+        frozen_bn.running_mean.copy_(bn.running_mean)
+        frozen_bn.running_var.copy_(bn.running_var)
+        frozen_bn.num_batches_tracked.copy_(bn.num_batches_tracked)
+        return frozen_bn
+
+    def forward(self, x):
+        scale = self.weight * torch.rsqrt(self.running_var + self.eps)
+        shift = self.bias - self.running_mean * scale
+        return torch.addcmul(shift[None, :, None, None], x, scale[None, :, None, None])
+
+
 class Bottleneck(nn.Module):
     def __init__(self, in_channels, out_channels, stride=1, dilation=1, downsample=None):
         super().__init__()
@@ -34,23 +127,28 @@ class Bottleneck(nn.Module):
         self.bn3 = nn.BatchNorm2d(out_channels * 4)
 
         self.downsample = downsample
+        # If `True`, the ReLUs and the residual addition overwrite their inputs whenever gradients
+        # are not being recorded.
+        self.inplace = False
 
     def forward(self, x):
-        skip = x.clone()
-        if self.downsample is not None:
-            skip = self.downsample(skip)
+        skip = x if self.downsample is None else self.downsample(x)
+        inplace = self.inplace and not torch.is_grad_enabled()
 
         x = self.conv1(x)
         x = self.bn1(x)
-        x = F.relu(x)
+        x = F.relu(x, inplace=inplace)
         x = self.conv2(x)
         x = self.bn2(x)
-        x = F.relu(x)
+        x = F.relu(x, inplace=inplace)
         x = self.conv3(x)
         x = self.bn3(x)
 
-        x = x + skip
-        x = F.relu(x)
+        if inplace:
+            x += skip
+        else:
+            x = x + skip
+        x = F.relu(x, inplace=inplace)
         return x
 
 
@@ -76,9 +174,11 @@ class ResNetBlock(nn.Module):
                 Bottleneck(in_channels=out_channels * 4, out_channels=out_channels, stride=1, dilation=1),
             )
         self.layers = nn.Sequential(*self.layers)
+        # See `checkpoint_sequential`.
+        self.checkpoint_segments = 0
 
     def forward(self, x):
-        x = self.layers(x)
+        x = checkpoint_sequential(self.layers, x, n_segments=self.checkpoint_segments)
         return x
 
 
@@ -111,18 +211,36 @@ class MultiGridResNetBlock(nn.Module):
                 ),
             )
         self.layers = nn.Sequential(*self.layers)
+        # See `checkpoint_sequential`.
+        self.checkpoint_segments = 0
 
     def forward(self, x):
-        x = self.layers(x)
+        x = checkpoint_sequential(self.layers, x, n_segments=self.checkpoint_segments)
         return x
 
 
+def load_resnet101(pretrained=True, weights_path=None):
+    """
+    The ImageNet weights are only resolved when `pretrained=True`: from `weights_path` if given,
+    otherwise from the torch hub cache (downloaded on the first call only).
+    """
+    model = resnet101(weights=None)
+    if pretrained:
+        if weights_path is not None:
+            state_dict = torch.load(weights_path, map_location="cpu")
+        else:
+            state_dict = ResNet101_Weights.DEFAULT.get_state_dict(progress=True)
+        model.load_state_dict(state_dict)
+    return model
+
+
 class ResNet101Backbone(nn.Module):
     def __init__(
         self,
         output_stride,
         multi_grid=(1, 2, 4),
-        RESNET101=resnet101(weights=ResNet101_Weights.DEFAULT),
+        pretrained=True,
+        weights_path=None,
     ):
         """
         "When output `output_stride = 8`, the last two blocks ('block3' and 'block4')
@@ -130,6 +248,7 @@ class ResNet101Backbone(nn.Module):
         """
         super().__init__()
 
+        RESNET101 = load_resnet101(pretrained=pretrained, weights_path=weights_path)
         self.conv1 = RESNET101.conv1
         self.bn1 = RESNET101.bn1
         self.maxpool = RESNET101.maxpool
@@ -171,12 +290,13 @@ class ConvBlock(nn.Module):
         self.kernel_size = kernel_size
         self.dilation = dilation
 
+        # Same as `padding="same"` for odd kernel sizes, which quantized convolutions do not support.
         self.conv = nn.Conv2d(
             in_channels,
             256,
             kernel_size,
             1,
-            "same",
+            dilation * (kernel_size - 1) // 2,
             dilation,
             bias=False
         )
@@ -204,14 +324,14 @@ class ImagePooling(nn.Module):
         "We apply global average pooling on the last feature map of the model, feed
             the resulting image-level features to a 1×1 convolution with 256 filters
             (and batch normalization), and then bilinearly upsample the feature to the desired spatial dimension."
-        """
-        _, _, w, h = x.shape
 
+        Bilinearly upsampling a 1×1 feature map is a broadcast, so the output is left as `(b, 256, 1, 1)`
+        and broadcast by the caller.
+        """
         x = self.global_avg_pool(x) # `(b, 64, 1, 1)`
         x = self.conv(x) # `(b, 256, 1, 1)`
         x = self.bn(x)
         x = self.relu(x)
-        x = F.interpolate(x, size=(w, h), mode="bilinear", align_corners=False) # `(b, 256, h, w)`
         return x
 
 
@@ -230,27 +350,80 @@ class ASPP(nn.Module):
         self.conv_block3 = ConvBlock(in_channels=2048, kernel_size=3, dilation=atrous_rates[1])
         self.conv_block4 = ConvBlock(in_channels=2048, kernel_size=3, dilation=atrous_rates[2])
         self.image_pooling = ImagePooling()
+        # If `True`, each branch is checkpointed with `checkpoint_module`.
+        self.checkpoint = False
+
+    def _apply_branch(self, branch, x, weight=None, bias=None):
+        fn = branch if weight is None else lambda x: F.conv2d(branch(x), weight, bias)
+        if self.checkpoint and torch.is_grad_enabled():
+            return checkpoint_module(fn, branch, x)
+        return fn(x)
     
-    def forward(self, x): # `(b, 64, h, w)`
+    def forward(self, x, proj=None): # `(b, 64, h, w)`
         """
         "The resulting features from all the branches are then concatenated."
+
+        If `proj`, the 1×1 `ConvBlock` applied to the concatenation, is given, its convolution is
+        split along the input channels and applied to each branch, and the results are summed.
+        This gives `proj(self(x))` without materializing the `(b, 256 * 5, h, w)` concatenation,
+        and the image-level features only ever contribute a per-sample `(b, 256, 1, 1)` bias.
         """
-        x1 = self.conv_block1(x) # `(b, 256, h, w)`
-        x2 = self.conv_block2(x) # `(b, 256, h, w)`
-        x3 = self.conv_block3(x) # `(b, 256, h, w)`
-        x4 = self.conv_block4(x) # `(b, 256, h, w)`
-        x5 = self.image_pooling(x) # `(b, 256, h, w)`
-        x = torch.cat([x1, x2, x3, x4, x5], dim=1) # `(b, 256 * 5, h, w)`
-        return x
+        if proj is None:
+            x1 = self._apply_branch(self.conv_block1, x) # `(b, 256, h, w)`
+            x2 = self._apply_branch(self.conv_block2, x) # `(b, 256, h, w)`
+            x3 = self._apply_branch(self.conv_block3, x) # `(b, 256, h, w)`
+            x4 = self._apply_branch(self.conv_block4, x) # `(b, 256, h, w)`
+            x5 = self._apply_branch(self.image_pooling, x).expand_as(x1) # `(b, 256, h, w)`
+            x = torch.cat([x1, x2, x3, x4, x5], dim=1) # `(b, 256 * 5, h, w)`
+            return x
+
+        branches = [
+            self.conv_block1, self.conv_block2, self.conv_block3, self.conv_block4, self.image_pooling,
+        ]
+        weights = proj.conv.weight.split(256, dim=1)
+        out = self._apply_branch(branches[0], x, weight=weights[0], bias=proj.conv.bias) # `(b, 256, h, w)`
+        for branch, weight in zip(branches[1:], weights[1:]):
+            out.add_(self._apply_branch(branch, x, weight=weight))
+        out = proj.bn(out)
+        out = proj.relu(out)
+        return out
+
+
+def convert_block3_state_dict(state_dict, output_stride):
+    """
+    'block3' is torchvision's `layer3` when `output_stride = 16` but a `ResNetBlock` when
+    `output_stride = 8`, with the same parameters under different keys ('block3.0.' and
+    'block3.layers.0.'). Renames the keys of `state_dict` for the given `output_stride`, so that a
+    checkpoint of either can be loaded into the other.
+    """
+    new_state_dict = OrderedDict()
+    for key, value in state_dict.items():
+        if output_stride == 8:
+            key = re.sub(r"^backbone\.block3\.(\d+)\.", r"backbone.block3.layers.\1.", key)
+        elif output_stride == 16:
+            key = re.sub(r"^backbone\.block3\.layers\.(\d+)\.", r"backbone.block3.\1.", key)
+        new_state_dict[key] = value
+    return new_state_dict
 
 
 class ResNet101DeepLabv3(nn.Module):
-    def __init__(self, output_stride=16, n_classes=21):
+    def __init__(
+        self,
+        output_stride=16,
+        n_classes=21,
+        pretrained_backbone=True,
+        backbone_weights_path=None,
+        aspp_mode="accumulate",
+    ):
         """
         "We apply atrous convolution with rates determined by the desired output stride value."
         "Note that the rates are doubled when `output_stride = 8`."
         "Pass through another 1×1 convolution (also with 256 filters and batch normalization)
             before the final 1×1 convolution which generates the final logits."
+
+        Set `pretrained_backbone=False` when a full checkpoint is loaded right after construction.
+        `aspp_mode="accumulate"` applies `conv_block` to the ASPP branches one by one (see `ASPP.forward`)
+        while `aspp_mode="concat"` concatenates them first. Both give the same output.
         """
         super().__init__()
 
@@ -259,22 +432,149 @@ class ResNet101DeepLabv3(nn.Module):
         elif output_stride == 8:
             self.atrous_rates = (12, 24, 36)
 
-        self.backbone = ResNet101Backbone(output_stride=output_stride)
+        self.backbone = ResNet101Backbone(
+            output_stride=output_stride,
+            pretrained=pretrained_backbone,
+            weights_path=backbone_weights_path,
+        )
         self.aspp = ASPP(atrous_rates=self.atrous_rates)
         self.conv_block = ConvBlock(in_channels=1280, kernel_size=1, dilation=1)
         self.fin_conv = nn.Conv2d(256, n_classes, 1)
+        if aspp_mode not in ("accumulate", "concat"):
+            raise ValueError(f"Unknown aspp_mode '{aspp_mode}'.")
+        self.aspp_mode = aspp_mode
 
-    def forward(self, x):
-        _, _, h, w = x.shape
-
+    @classmethod
+    def from_checkpoint(cls, ckpt_path, output_stride=16, n_classes=21, device="cpu"):
+        """
+        Builds the model on the meta device and assigns the checkpoint tensors to it, so neither
+        the ImageNet weights nor the random initialization are ever computed.
+        """
+        state_dict = torch.load(ckpt_path, map_location=device)
+        if "model" in state_dict:
+            state_dict = state_dict["model"]
+        state_dict = modify_state_dict(state_dict)
+        state_dict = convert_block3_state_dict(state_dict, output_stride=output_stride)
+        with torch.device("meta"):
+            model = cls(output_stride=output_stride, n_classes=n_classes, pretrained_backbone=False)
+        model.load_state_dict(state_dict, assign=True)
+        return model
+
+    def get_logits(self, x):
+        """
+        Returns the logits at `1 / output_stride` of the input resolution.
+        """
         x = self.backbone(x)
-        x = self.aspp(x)
-        x = self.conv_block(x)
+        if self.aspp_mode == "accumulate":
+            x = self.aspp(x, proj=self.conv_block)
+        elif self.aspp_mode == "concat":
+            x = self.aspp(x)
+            x = self.conv_block(x)
         x = self.fin_conv(x)
+        return x
+
+    def forward(self, x):
+        # Not unpacked, so that the model can be symbolically traced.
+        size = x.shape[2:]
 
-        x = F.interpolate(x, size=(w, h), mode="bilinear", align_corners=True)
+        x = self.get_logits(x)
+        x = F.interpolate(x, size=size, mode="bilinear", align_corners=True)
         return x
 
+    @torch.inference_mode()
+    def predict_labels(self, x, max_upsample=None, chunk_size=64):
+        """
+        Returns `(b, 1, h, w)` label maps (dtype: `torch.uint8`).
+
+        With `max_upsample=None` the labels are those of `torch.argmax(self(x), dim=1, keepdim=True)`,
+        but the bilinear upsampling is done separably and `chunk_size` output rows at a time, so the
+        full-resolution logits are never materialized. Otherwise the logits are upsampled by at most
+        `max_upsample` before the argmax and the labels are resized with nearest neighbor, trading
+        accuracy at the object boundaries for latency.
+        """
+        _, _, h, w = x.shape
+
+        x = self.get_logits(x) # `(b, n_classes, h / output_stride, w / output_stride)`
+        _, _, low_h, low_w = x.shape
+        if max_upsample is not None:
+            size = (min(h, round(low_h * max_upsample)), min(w, round(low_w * max_upsample)))
+            x = F.interpolate(x, size=size, mode="bilinear", align_corners=True)
+            argmax = torch.argmax(x, dim=1, keepdim=True).byte()
+            return F.interpolate(argmax, size=(h, w), mode="nearest")
+
+        # Upsample horizontally only, then interpolate between rows chunk by chunk.
+        x = F.interpolate(x, size=(low_h, w), mode="bilinear", align_corners=True)
+        src_y = torch.arange(h, device=x.device, dtype=x.dtype) * ((low_h - 1) / max(h - 1, 1))
+        top = src_y.floor().long()
+        bottom = (top + 1).clamp(max=low_h - 1)
+        frac = (src_y - top)[:, None]
+
+        labels = torch.empty((x.size(0), 1, h, w), dtype=torch.uint8, device=x.device)
+        for start in range(0, h, chunk_size):
+            end = min(start + chunk_size, h)
+            chunk = torch.lerp(
+                x[:, :, top[start: end]], x[:, :, bottom[start: end]], frac[start: end],
+            ) # `(b, n_classes, chunk_size, w)`
+            labels[:, 0, start: end] = torch.argmax(chunk, dim=1)
+        return labels
+
+    @torch.no_grad()
+    def freeze_bn(self):
+        """
+        "We then freeze batch normalization parameters"
+
+        Replaces every `nn.BatchNorm2d` with a `FrozenBatchNorm2d`, so neither the statistics nor
+        the affine parameters are trained anymore.
+        """
+        for module in list(self.modules()):
+            for name, child in module.named_children():
+                if isinstance(child, nn.BatchNorm2d):
+                    setattr(module, name, FrozenBatchNorm2d.from_batchnorm(child))
+        return self
+
+    def set_activation_checkpointing(self, block3_segments=0, block4_segments=0, aspp=False):
+        """
+        Trades compute for memory in training: 'block3' and 'block4' are split into the given
+        numbers of checkpointed segments (see `checkpoint_sequential`) and the ASPP branches are
+        checkpointed one by one. 'block3' can be checkpointed only when `output_stride = 8`, where
+        its 23 bottlenecks run at `1 / 8` of the input resolution.
+        """
+        if block3_segments > 0 and not isinstance(self.backbone.block3, ResNetBlock):
+            raise ValueError("'block3' can be checkpointed only when `output_stride = 8`.")
+        if isinstance(self.backbone.block3, ResNetBlock):
+            self.backbone.block3.checkpoint_segments = block3_segments
+        self.backbone.block4.checkpoint_segments = block4_segments
+        self.aspp.checkpoint = aspp
+
+    @torch.no_grad()
+    def fuse_for_inference(self):
+        """
+        Returns an eval-only copy of the model in which every batch normalization is folded into the
+        bias-free convolution before it, and every ReLU and residual addition runs in place.
+        """
+        model = copy.deepcopy(self).eval()
+        for module in model.modules():
+            if isinstance(module, nn.Sequential):
+                pairs = [(str(idx), str(idx + 1)) for idx in range(len(module) - 1)]
+            else:
+                pairs = [
+                    (name.replace("bn", "conv"), name)
+                    for name, _ in module.named_children()
+                    if name.startswith("bn")
+                ]
+            for conv_name, bn_name in pairs:
+                conv = getattr(module, conv_name, None)
+                bn = getattr(module, bn_name)
+                if isinstance(conv, nn.Conv2d) and isinstance(bn, (nn.BatchNorm2d, FrozenBatchNorm2d)):
+                    setattr(module, conv_name, fuse_conv_bn_eval(conv, bn))
+                    setattr(module, bn_name, nn.Identity())
+
+            if isinstance(getattr(module, "relu", None), nn.ReLU):
+                module.relu.inplace = True
+            if isinstance(module, Bottleneck):
+                module.inplace = True
+        return model
+
     def get_loss(self, image, gt):
         """
         "Our loss function is the sum of cross-entropy terms for each spatial position in
@@ -285,39 +585,17 @@ class ResNet101DeepLabv3(nn.Module):
         References:
             https://github.com/VainF/DeepLabV3Plus-Pytorch/blob/master/utils/loss.py
         """
-        pred = self(image)
-        pred = einops.rearrange(pred, pattern="b c h w -> (b h w) c")
-        gt = einops.rearrange(gt, pattern="b c h w -> (b h w) c").squeeze(1)
-        return F.cross_entropy(pred, gt, ignore_index=255, reduction="mean")
+        return self.compute_loss(pred=self(image), gt=gt)
 
     @staticmethod
-    def get_pixel_iou_by_cls(pred, gt):
+    def compute_loss(pred, gt):
         """
-        "The performance is measured in terms of pixel intersection-over-union (IOU) averaged
-            across the 21 classes."
-
-        References:
-            https://gaussian37.github.io/vision-segmentation-miou/
-            https://stackoverflow.com/questions/62461379/multiclass-semantic-segmentation-model-evaluation
+        The loss of `get_loss` from the output of the forward pass, for when it has to go through
+        a wrapper such as `DistributedDataParallel`.
         """
-        argmax = torch.argmax(pred, dim=1, keepdim=True)
-
-        ious = dict()
-        for idx, c in enumerate(VOC_CLASSES):
-            if c == "background":
-                continue
-
-            pred_mask = (argmax == idx)
-            gt_mask = (gt == idx)
-            if gt_mask.sum().item() == 0:
-                continue
-
-            union = (pred_mask | gt_mask).sum().item()
-            intersec = (pred_mask & gt_mask).sum().item()
-            iou = intersec / union
-
-            ious[c] = round(iou, 4)
-        return ious
+        pred = einops.rearrange(pred, pattern="b c h w -> (b h w) c")
+        gt = einops.rearrange(gt, pattern="b c h w -> (b h w) c").squeeze(1)
+        return F.cross_entropy(pred, gt, ignore_index=255, reduction="mean")
 
 
 if __name__ == "__main__":
@@ -6,19 +6,31 @@ from pathlib import Path
 
 from voc2012 import VOC2012Dataset
 from model import ResNet101DeepLabv3
-from utils import modify_state_dict, visualize_batched_image_and_gt
+from inference import MultiScalePredictor
+from utils import visualize_batched_image_and_gt
 
 
 def get_args():
     parser = argparse.ArgumentParser()
 
     parser.add_argument("--ckpt_path", type=str, required=True)
+    # The checkpoints of either stage can be evaluated at either output stride.
+    parser.add_argument("--output_stride", type=int, required=False, default=16, choices=[16, 8])
     parser.add_argument("--img_dir", type=str, required=True)
     parser.add_argument("--gt_dir", type=str, required=True)
     parser.add_argument("--batch_size", type=int, required=True)
     parser.add_argument("--n_cpus", type=int, required=True)
+    ### Test-time augmentation
+    parser.add_argument("--scales", type=float, nargs="+", required=False, default=[1.0])
+    parser.add_argument("--flip", action="store_true")
 
     args = parser.parse_args()
+
+    args_dict = vars(args)
+    new_args_dict = dict()
+    for k, v in args_dict.items():
+        new_args_dict[k.upper()] = v
+    args = argparse.Namespace(**new_args_dict)
     return args
 
 
@@ -30,18 +42,24 @@ if __name__ == "__main__":
     val_dl = DataLoader(val_ds, batch_size=args.BATCH_SIZE, shuffle=False, num_workers=args.N_CPUS)
 
     DEVICE = torch.device("cpu")
-    model = ResNet101DeepLabv3(output_stride=16).to(DEVICE)
-    state_dict = torch.load(args.ckpt_path, map_location=DEVICE)
-    state_dict = modify_state_dict(state_dict["model"])
-    model.load_state_dict(state_dict)
+    model = ResNet101DeepLabv3.from_checkpoint(
+        args.CKPT_PATH, output_stride=args.OUTPUT_STRIDE, device=DEVICE,
+    )
+    model.eval()
+    if args.SCALES != [1.0] or args.FLIP:
+        tta = MultiScalePredictor(model=model, scales=args.SCALES, flip=args.FLIP)
+    else:
+        tta = None
 
     with torch.no_grad():
         for batch, (image, gt) in enumerate(tqdm(val_dl), start=1):
             image = image.to(DEVICE)
             gt = gt.to(DEVICE)
 
-            pred = model(image)
-            argmax = torch.argmax(pred, dim=1, keepdim=True)
+            if tta is not None:
+                argmax, _ = tta.predict(image)
+            else:
+                argmax = model.predict_labels(image)
 
             gt_vis = visualize_batched_image_and_gt(image=image, gt=gt, n_cols=4, alpha=0.7)
             gt_vis.save(ROOT/f"voc2012_val_predictions/{batch}_gt.jpg")
@@ -0,0 +1,129 @@
+# References:
+    # https://pytorch.org/tutorials/prototype/fx_graph_mode_ptq_static.html
+
+import torch
+from torch.utils.data import DataLoader, Subset
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from pathlib import Path
+from time import time
+import argparse
+import random
+import copy
+import io
+
+from voc2012 import VOC2012Dataset
+from model import ResNet101DeepLabv3
+from metrics import ConfusionMatrix
+from utils import set_seed
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--seed", type=int, required=False, default=123)
+    parser.add_argument("--ckpt_path", type=str, required=True)
+    parser.add_argument("--img_dir", type=str, required=True)
+    parser.add_argument("--gt_dir", type=str, required=True)
+    parser.add_argument("--save_path", type=str, required=True)
+    parser.add_argument("--n_calib_images", type=int, required=False, default=100)
+    parser.add_argument("--n_eval_images", type=int, required=False)
+    parser.add_argument("--n_cpus", type=int, required=False, default=4)
+    parser.add_argument("--backend", type=str, required=False, default="x86")
+
+    args = parser.parse_args()
+
+    args_dict = vars(args)
+    new_args_dict = dict()
+    for k, v in args_dict.items():
+        new_args_dict[k.upper()] = v
+    args = argparse.Namespace(**new_args_dict)
+    return args
+
+
+@torch.inference_mode()
+def quantize(model, calib_dl, backend="x86"):
+    """
+    Post-training static quantization: the conv-BN-ReLU patterns are fused, the activation ranges
+    are observed on `calib_dl` and the model is converted to int8.
+    """
+    model = copy.deepcopy(model).eval()
+    # The per-branch accumulation of `ASPP` is done in place, which can not be quantized.
+    model.aspp_mode = "concat"
+
+    image, _ = next(iter(calib_dl))
+    prepared = prepare_fx(
+        model, get_default_qconfig_mapping(backend), example_inputs=(image,),
+    )
+    for image, _ in calib_dl:
+        prepared(image)
+    return convert_fx(prepared)
+
+
+@torch.inference_mode()
+def evaluate(model, dl):
+    conf_mat = ConfusionMatrix()
+    elapsed = 0
+    n_images = 0
+    for image, gt in dl:
+        start_time = time()
+        pred = model(image)
+        elapsed += time() - start_time
+        n_images += image.size(0)
+        conf_mat.update(pred=pred, gt=gt)
+    return conf_mat.get_scores()["miou"], elapsed / n_images
+
+
+def get_serialized_size(obj):
+    buffer = io.BytesIO()
+    torch.save(obj, buffer)
+    return buffer.getbuffer().nbytes
+
+
+def main():
+    args = get_args()
+    set_seed(args.SEED)
+    torch.backends.quantized.engine = args.BACKEND
+
+    model = ResNet101DeepLabv3.from_checkpoint(args.CKPT_PATH, output_stride=16, device="cpu")
+    model.eval()
+
+    # The calibration images are held out from the evaluation.
+    val_ds = VOC2012Dataset(img_dir=args.IMG_DIR, gt_dir=args.GT_DIR, split="val")
+    indices = list(range(len(val_ds)))
+    random.shuffle(indices)
+    calib_indices = indices[: args.N_CALIB_IMAGES]
+    eval_indices = indices[args.N_CALIB_IMAGES:]
+    if args.N_EVAL_IMAGES is not None:
+        eval_indices = eval_indices[: args.N_EVAL_IMAGES]
+    calib_dl = DataLoader(
+        Subset(val_ds, calib_indices), batch_size=1, shuffle=False, num_workers=args.N_CPUS,
+    )
+    eval_dl = DataLoader(
+        Subset(val_ds, eval_indices), batch_size=1, shuffle=False, num_workers=args.N_CPUS,
+    )
+
+    quantized = quantize(model=model, calib_dl=calib_dl, backend=args.BACKEND)
+
+    image, _ = next(iter(eval_dl))
+    with torch.inference_mode():
+        scripted = torch.jit.trace(quantized, image)
+    Path(args.SAVE_PATH).parent.mkdir(parents=True, exist_ok=True)
+    torch.jit.save(scripted, args.SAVE_PATH)
+
+    fp32_miou, fp32_latency = evaluate(model=model, dl=eval_dl)
+    int8_miou, int8_latency = evaluate(model=scripted, dl=eval_dl)
+    fp32_size = get_serialized_size(model.state_dict())
+    int8_size = Path(args.SAVE_PATH).stat().st_size
+    print(f"[ Calibrated on {len(calib_indices):,} and evaluated on {len(eval_indices):,} images. ]")
+    for name, miou, latency, size in [
+        ("fp32", fp32_miou, fp32_latency, fp32_size),
+        ("int8", int8_miou, int8_latency, int8_size),
+    ]:
+        log = f"[ {name} ][ mIoU: {miou:.4f} ][ Latency: {latency * 1000:,.1f}ms/image ]"
+        log += f"[ Size: {size / 2 ** 20:,.1f}MiB ]"
+        print(log)
+
+
+if __name__ == "__main__":
+    main()
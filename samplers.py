@@ -0,0 +1,105 @@
+import torch
+from torch.utils.data import Sampler
+import random
+
+
+class AspectRatioBucketSampler(Sampler):
+    """
+    A batch sampler which groups the images of similar aspect ratios, so that a batch has to be
+    padded only to the largest image in it (see `collate_padded`) rather than to a fixed square.
+
+    The indices are sorted by aspect ratio and cut into consecutive batches. With `shuffle=True`,
+    the order of the batches (not their content) changes with `set_epoch`. With several processes,
+    each one takes every `world_size`-th batch, so every sample is used exactly once.
+    """
+    def __init__(self, aspect_ratios, batch_size, shuffle=False, seed=0, rank=0, world_size=1):
+        self.aspect_ratios = aspect_ratios
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+        indices = sorted(range(len(aspect_ratios)), key=lambda idx: aspect_ratios[idx])
+        self.batches = [
+            indices[idx: idx + batch_size] for idx in range(0, len(indices), batch_size)
+        ]
+
+    @classmethod
+    def from_dataset(cls, ds, batch_size, shuffle=False, seed=0, rank=0, world_size=1):
+        """
+        Reads the sizes of the images of a `VOC2012Dataset` from its manifest.
+        """
+        aspect_ratios = [sample["height"] / sample["width"] for sample in ds.samples]
+        return cls(
+            aspect_ratios=aspect_ratios,
+            batch_size=batch_size,
+            shuffle=shuffle,
+            seed=seed,
+            rank=rank,
+            world_size=world_size,
+        )
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.batches[self.rank:: self.world_size])
+
+    def __iter__(self):
+        batches = self.batches
+        if self.shuffle:
+            batches = batches.copy()
+            random.Random(self.seed + self.epoch).shuffle(batches)
+        yield from batches[self.rank:: self.world_size]
+
+
+class InfiniteSampler(Sampler):
+    """
+    Yields `(idx, seed)` pairs without end, for iteration-based training. Each epoch is a new
+    permutation of the indices, and each sample comes with its own seed for the augmentation (see
+    `VOC2012Dataset.__getitem__`), so the samples and their augmentation depend only on `seed`
+    and on the position in the stream, not on the number of `DataLoader` workers.
+
+    The position is just the number of samples consumed, so resuming from `start` is exact and
+    does not replay any batch. With several processes, the stream is dealt out to them in turn, as
+    `DistributedSampler` does for each epoch, and `start` counts the samples of all processes.
+    """
+    def __init__(self, n_samples, shuffle=True, seed=0, start=0, rank=0, world_size=1):
+        self.n_samples = n_samples
+        self.shuffle = shuffle
+        self.seed = seed
+        self.start = start
+        self.rank = rank
+        self.world_size = world_size
+
+    def state_dict(self, n_consumed):
+        """
+        The `DataLoader` runs ahead of the training loop by the prefetched batches, so the number
+        of samples actually consumed is given by the caller.
+        """
+        return {"seed": self.seed, "start": n_consumed}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict["seed"]
+        self.start = state_dict["start"]
+
+    def _get_epoch(self, epoch):
+        gen = torch.Generator()
+        gen.manual_seed(self.seed + epoch)
+        if self.shuffle:
+            indices = torch.randperm(self.n_samples, generator=gen)
+        else:
+            indices = torch.arange(self.n_samples)
+        seeds = torch.randint(2 ** 31, size=(self.n_samples,), generator=gen)
+        return indices.tolist(), seeds.tolist()
+
+    def __iter__(self):
+        epoch, offset = divmod(self.start + self.rank, self.n_samples)
+        while True:
+            indices, seeds = self._get_epoch(epoch)
+            yield from zip(indices[offset:: self.world_size], seeds[offset:: self.world_size])
+            # Where the next epoch starts for this process.
+            offset = (offset - self.n_samples) % self.world_size
+            epoch += 1
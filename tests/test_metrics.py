@@ -0,0 +1,11 @@
+import torch
+
+from metrics import ConfusionMatrix
+
+
+def test_out_of_range_labels_are_ignored():
+    conf_mat = ConfusionMatrix(n_classes=3, ignore_index=255)
+    gt = torch.tensor([0, 1, 2, 3, 255, -1, 100000, 1]).view(1, 1, 2, 4)
+    pred = torch.tensor([0, 1, 2, 0, 1, 1, 2, 7]).view(1, 1, 2, 4)
+    conf_mat.update(pred, gt)
+    assert torch.equal(conf_mat.mat, torch.eye(3, dtype=torch.int64))
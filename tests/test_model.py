@@ -0,0 +1,47 @@
+import torch
+import torch.nn as nn
+import pytest
+
+from model import ResNet101DeepLabv3
+
+
+def get_model(**kwargs):
+    torch.manual_seed(0)
+    model = ResNet101DeepLabv3(pretrained_backbone=False, **kwargs).eval()
+    # Non-trivial statistics, as after training.
+    for module in model.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.1, 0.1)
+            module.running_var.uniform_(0.5, 1.5)
+    return model
+
+
+def assert_close(actual, expected, rtol=1e-5):
+    # The logits of a randomly initialized model are large, so the absolute tolerance is relative
+    # to them.
+    torch.testing.assert_close(actual, expected, rtol=rtol, atol=rtol * expected.abs().max().item())
+
+
+@torch.inference_mode()
+def test_aspp_modes_are_equivalent():
+    # Non-square, and the sides are not multiples of the output stride.
+    x = torch.randn(2, 3, 97, 129)
+    model = get_model(aspp_mode="concat")
+    concat = model(x)
+    model.aspp_mode = "accumulate"
+    accumulate = model(x)
+    assert concat.shape == (2, 21, 97, 129)
+    assert_close(accumulate, concat)
+
+
+def test_unknown_aspp_mode():
+    with pytest.raises(ValueError):
+        ResNet101DeepLabv3(pretrained_backbone=False, aspp_mode="sum")
+
+
+@torch.inference_mode()
+def test_fuse_for_inference():
+    x = torch.randn(2, 3, 97, 129)
+    model = get_model()
+    fused = model.fuse_for_inference()
+    assert_close(fused(x), model(x))
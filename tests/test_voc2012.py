@@ -0,0 +1,52 @@
+import torch
+import numpy as np
+from PIL import Image
+import random
+
+from voc2012 import VOC2012Transform
+
+
+def get_aug_params(fused_aug, n_samples, seed, img_size=64, w=60, h=45):
+    """
+    Augments a ground truth whose labels increase from left to right (0 is left for the padding)
+    and reads back the parameters of each sample from the output: the fraction of padded pixels,
+    whether it is flipped, its scale and the mean label, i.e., the horizontal position of the crop.
+    """
+    n_levels = 200
+    gt = np.tile(1 + np.arange(w) * n_levels // w, (h, 1)).astype(np.uint8)
+    transform = VOC2012Transform(
+        img_size=img_size, mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5), split="train", fused_aug=fused_aug,
+    )
+    params = []
+    for idx in range(n_samples):
+        _, out = transform._transform(
+            image=Image.new("RGB", (w, h)),
+            gt=Image.fromarray(gt),
+            rng=random.Random(seed + idx),
+            gen=torch.Generator().manual_seed(seed + idx),
+        )
+        out = out[0].numpy().astype(np.int64)
+        valid = out > 0
+        labels = out[valid]
+        left = out[:, : img_size // 2][valid[:, : img_size // 2]]
+        right = out[:, img_size // 2:][valid[:, img_size // 2:]]
+        flip = float(left.mean() > right.mean()) if left.size and right.size else np.nan
+        label_range = labels.max() - labels.min()
+        scale = valid.any(axis=0).sum() / (label_range * w / n_levels) if label_range >= 20 else np.nan
+        params.append((1 - valid.mean(), flip, scale, labels.mean()))
+    return np.array(params)
+
+
+def test_fused_aug_matches_sequential_aug():
+    n_samples = 1000
+    seq = get_aug_params(fused_aug=False, n_samples=n_samples, seed=0)
+    fused = get_aug_params(fused_aug=True, n_samples=n_samples, seed=n_samples)
+    for idx, name in enumerate(["pad_ratio", "flip", "scale", "crop_position"]):
+        seq_values = seq[:, idx][np.isfinite(seq[:, idx])]
+        fused_values = fused[:, idx][np.isfinite(fused[:, idx])]
+        std_err = (
+            seq_values.var() / seq_values.size + fused_values.var() / fused_values.size
+        ) ** 0.5
+        diff = abs(seq_values.mean() - fused_values.mean())
+        # Two-sample z-test: the means may differ by chance, but not by more than 4 standard errors.
+        assert diff < 4 * std_err, (name, seq_values.mean(), fused_values.mean())
@@ -2,6 +2,9 @@
     # https://github.com/PengtaoJiang/OAA-PyTorch/blob/master/deeplab-pytorch/libs/utils/lr_scheduler.py
 
 import torch
+import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data import DataLoader
 from torch.optim import SGD, AdamW
 from pathlib import Path
@@ -9,10 +12,13 @@ from time import time
 import contextlib
 from tqdm import tqdm
 import argparse
+import random
 
-from voc2012 import VOC2012Dataset
+from voc2012 import VOC2012Dataset, BatchAugmentation, collate_uint8, collate_padded
+from samplers import AspectRatioBucketSampler, InfiniteSampler
 from model import ResNet101DeepLabv3
-from utils import get_elapsed_time, get_device, set_seed, get_grad_scaler
+from metrics import ConfusionMatrix
+from utils import get_elapsed_time, init_dist, set_seed, get_grad_scaler
 
 
 def get_args():
@@ -22,12 +28,31 @@ def get_args():
     parser.add_argument("--img_dir", type=str, required=True)
     parser.add_argument("--gt_dir", type=str, required=True)
     parser.add_argument("--save_dir", type=str, required=True)
+    # Per process when launched with `torchrun`.
     parser.add_argument("--batch_size", type=int, required=True)
+    parser.add_argument("--val_batch_size", type=int, required=False, default=8)
+    # Each step accumulates the gradients of `grad_accum_steps` batches of `batch_size`.
+    parser.add_argument("--grad_accum_steps", type=int, required=False, default=1)
     parser.add_argument("--n_cpus", type=int, required=True)
     parser.add_argument("--n_steps", type=int, required=False, default=30_000) # In the paper
     parser.add_argument("--resume_from", type=str, required=False)
+    # 1: `output_stride = 16` from the ImageNet weights. 2: `output_stride = 8` with frozen batch
+    # normalization from the stage 1 checkpoint `init_from`. A resumed run keeps its stage.
+    parser.add_argument("--stage", type=int, required=False, default=1, choices=[1, 2])
+    parser.add_argument("--init_from", type=str, required=False)
+    # If set, the workers only decode and the augmentation runs batched on `DEVICE`.
+    parser.add_argument("--batch_aug", action="store_true")
+    # Copies the pinned batches to `DEVICE` asynchronously.
+    parser.add_argument("--non_blocking", action="store_true")
+    # Activation checkpointing (see `ResNet101DeepLabv3.set_activation_checkpointing`).
+    parser.add_argument("--checkpoint_block3", type=int, required=False, default=0)
+    parser.add_argument("--checkpoint_block4", type=int, required=False, default=0)
+    parser.add_argument("--checkpoint_aspp", action="store_true")
+    # Batch normalization statistics computed over the batches of all processes.
+    parser.add_argument("--sync_bn", action="store_true")
     ### Optimizer
-    parser.add_argument("--init_lr", type=float, required=False, default=0.007)
+    # 0.007 for stage 1 and 0.001 for stage 2 by default, as in the paper.
+    parser.add_argument("--init_lr", type=float, required=False)
     # parser.add_argument("--momentum", type=float, required=False, default=0.9)
     # parser.add_argument("--weight_decay", type=float, required=False, default=0.0008)
     ### Logging
@@ -63,13 +88,35 @@ class Trainer(object):
         init_lr,
         n_steps,
         device,
+        batch_aug=None,
+        rank=0,
+        world_size=1,
+        grad_accum_steps=1,
+        stage=1,
+        non_blocking=False,
     ):
+        """
+        When launched with `torchrun`, every process runs a `Trainer` on its own share of the
+        data (see `InfiniteSampler` and `AspectRatioBucketSampler`) and only rank 0 logs and saves.
+
+        With `grad_accum_steps > 1`, each step takes that many batches, so the gradients are those
+        of a batch of `grad_accum_steps × batch_size × world_size`. The batch normalization
+        statistics are still computed per batch (per process unless `SyncBatchNorm` is used).
+        """
         self.train_dl = train_dl
         self.val_dl = val_dl
         self.save_dir = Path(save_dir)
         self.init_lr = init_lr
         self.n_steps = n_steps
         self.device = device
+        self.batch_aug = batch_aug
+        self.rank = rank
+        self.world_size = world_size
+        self.grad_accum_steps = grad_accum_steps
+        self.stage = stage
+        self.non_blocking = non_blocking
+
+        self.is_main = (rank == 0)
 
     def get_lr(self, step, power=0.9):
         """
@@ -83,36 +130,89 @@ class Trainer(object):
     def update_lr(lr, optim):
         optim.param_groups[0]["lr"] = lr
 
-    def train_for_one_step(self, image, gt, step, model, optim, scaler):
-        image = image.to(self.device)
-        gt = gt.to(self.device)
-
+    def train_for_one_step(self, batches, step, model, optim, scaler):
+        """
+        Takes one optimizer step on the gradients accumulated over `batches`. Returns the loss
+        averaged over them.
+        """
         lr = self.get_lr(step=step)
         self.update_lr(lr=lr, optim=optim)
 
-        with torch.autocast(
-            device_type=self.device.type, dtype=torch.float16,
-        ) if self.device.type == "cuda" else contextlib.nullcontext():
-            loss = model.get_loss(image=image, gt=gt)
         optim.zero_grad()
+        cum_loss = 0
+        for idx, batch in enumerate(batches):
+            batch = [i.to(self.device, non_blocking=self.non_blocking) for i in batch]
+            if self.batch_aug is not None:
+                image, gt = self.batch_aug(*batch)
+            else:
+                image, gt = batch
+
+            # The gradients are synced across processes only once, on the last batch.
+            with model.no_sync() if (
+                isinstance(model, DDP) and idx < len(batches) - 1
+            ) else contextlib.nullcontext():
+                with torch.autocast(
+                    device_type=self.device.type, dtype=torch.float16,
+                ) if self.device.type == "cuda" else contextlib.nullcontext():
+                    # Through the `DistributedDataParallel` wrapper, which syncs the gradients.
+                    pred = model(image)
+                    loss = ResNet101DeepLabv3.compute_loss(pred=pred, gt=gt) / len(batches)
+                if scaler is not None:
+                    scaler.scale(loss).backward()
+                else:
+                    loss.backward()
+            cum_loss += loss.detach()
+        # The gradients are unscaled and checked for infs once for all the batches.
         if scaler is not None:
-            scaler.scale(loss).backward()
             scaler.step(optim)
             scaler.update()
         else:
-            loss.backward()
             optim.step()
         # loss = torch.randn(size=(1,), device=self.device)
-        return loss
+        return cum_loss
+
+    @staticmethod
+    def unwrap(model):
+        return model.module if isinstance(model, DDP) else model
+
+    def get_rng_states(self):
+        """
+        Returns the RNG states of every process, to be called by all of them.
+        """
+        rng_states = {"python": random.getstate(), "torch": torch.get_rng_state()}
+        if torch.cuda.is_available():
+            rng_states["cuda"] = torch.cuda.get_rng_state_all()
+        if self.world_size == 1:
+            return [rng_states]
+        all_rng_states = [None] * self.world_size
+        dist.all_gather_object(all_rng_states, rng_states)
+        return all_rng_states
+
+    @staticmethod
+    def set_rng_states(rng_states):
+        # The states have to be CPU `ByteTensor`s, whatever `map_location` they were loaded with.
+        random.setstate(rng_states["python"])
+        torch.set_rng_state(rng_states["torch"].cpu())
+        if "cuda" in rng_states and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all([state.cpu() for state in rng_states["cuda"]])
+
+    def save_checkpoint(self, step, n_consumed, model, optim, scaler, max_avg_miou, save_path):
+        # Every process takes part in gathering the RNG states.
+        rng_states = self.get_rng_states()
+        if not self.is_main:
+            return
 
-    def save_checkpoint(self, step, model, optim, scaler, max_avg_miou, save_path):
         Path(save_path).parent.mkdir(parents=True, exist_ok=True)
         ckpt = {
             "step": step,
             "number_of_steps": self.n_steps,
-            "model": model.state_dict(),
+            "stage": self.stage,
+            "model": self.unwrap(model).state_dict(),
             "optimizer": optim.state_dict(),
             "maximum_average_mean_iou": max_avg_miou,
+            # Where the data stream and `BatchAugmentation` are at, to resume without replaying.
+            "sampler": self.train_dl.sampler.state_dict(n_consumed=n_consumed),
+            "rng_states": rng_states,
         }
         if scaler is not None:
             ckpt["scaler"] = scaler.state_dict()
@@ -120,13 +220,20 @@ class Trainer(object):
 
     def save_model_params(self, model, save_path):
         Path(save_path).parent.mkdir(parents=True, exist_ok=True)
-        torch.save(model.state_dict(), str(save_path))
+        torch.save(self.unwrap(model).state_dict(), str(save_path))
 
     @torch.inference_mode()
     def validate(self, model):
+        """
+        Each process validates its own share of the images, and the confusion matrices are
+        summed up, so all processes get the same scores.
+        """
+        # Bypasses the buffer broadcast of `DistributedDataParallel`, a collective operation
+        # which would hang when the processes do not get the same number of batches.
+        model = self.unwrap(model)
         model.eval()
-        cum_miou = 0
-        pbar = tqdm(self.val_dl)
+        conf_mat = ConfusionMatrix(device=self.device)
+        pbar = tqdm(self.val_dl, disable=not self.is_main)
         for image, gt in pbar:
             pbar.set_description("Validating...")
 
@@ -134,15 +241,11 @@ class Trainer(object):
             gt = gt.to(self.device)
 
             pred = model(image)
-            ious = model.get_pixel_iou_by_cls(pred=pred, gt=gt)
-            miou = sum(ious.values()) / len(ious)
-
-            cum_miou += miou
-        avg_miou = cum_miou / len(self.val_dl)
-        # import random
-        # avg_miou = random.random()
+            conf_mat.update(pred=pred, gt=gt)
+        conf_mat.all_reduce()
+        scores = conf_mat.get_scores()
         model.train()
-        return avg_miou
+        return scores
 
     def train(
         self,
@@ -156,40 +259,44 @@ class Trainer(object):
         val_every,
     ):
         train_di = iter(self.train_dl)
+        n_consumed = self.train_dl.sampler.start
 
-        cum_loss = 0
+        # Accumulated on the device, so that the host waits for it only every `log_every` steps.
+        cum_loss = torch.zeros((), device=self.device)
         start_time = time()
-        pbar = tqdm(range(init_step + 1, self.n_steps + 1), leave=False)
+        pbar = tqdm(range(init_step + 1, self.n_steps + 1), leave=False, disable=not self.is_main)
         for step in pbar:
             pbar.set_description("Training...")
 
-            try:
-                image, gt = next(train_di)
-            except StopIteration:
-                train_di = iter(self.train_dl)
-                image, gt = next(train_di)
+            # `InfiniteSampler` never runs out.
+            batches = [next(train_di) for _ in range(self.grad_accum_steps)]
             loss = self.train_for_one_step(
+                batches=batches,
                 step=step,
                 model=model,
                 optim=optim,
                 scaler=scaler,
-                image=image,
-                gt=gt,
             )
-            cum_loss += loss.item()
+            n_consumed += sum([batch[0].size(0) for batch in batches]) * self.world_size
+            cum_loss += loss
 
             if step % log_every == 0:
-                cum_loss /= log_every
+                if self.world_size > 1:
+                    dist.all_reduce(cum_loss, op=dist.ReduceOp.SUM)
+                    cum_loss /= self.world_size
+                avg_loss = cum_loss.item() / log_every
                 log = f"[ {get_elapsed_time(start_time)} ]"
                 log += f"[ {step:,}/{self.n_steps:,} ]\n"
-                log += f"[ Loss: {cum_loss:.4f} ]"
-                print(log)
-                cum_loss = 0
+                log += f"[ Loss: {avg_loss:.4f} ]"
+                if self.is_main:
+                    print(log)
+                cum_loss.zero_()
                 start_time = time()
 
             if step % save_every == 0:
                 self.save_checkpoint(
                     step=step,
+                    n_consumed=n_consumed,
                     model=model,
                     optim=optim,
                     scaler=scaler,
@@ -197,39 +304,82 @@ class Trainer(object):
                     save_path=self.save_dir/f"step={step}.pth",
                 )
                 log = f"[ {step:,}/{self.n_steps:,} ][ Checkpoint saved. ]"
-                print(log)
+                if self.is_main:
+                    print(log)
 
             if step % val_every == 0:
-                avg_miou = self.validate(model=model)
+                scores = self.validate(model=model)
+                avg_miou = scores["miou"]
                 if avg_miou > max_avg_miou:
-                    self.save_model_params(
-                        model=model,
-                        save_path=self.save_dir/f"step={step}-avg_miou={avg_miou:.4f}.pth",
-                    )
+                    if self.is_main:
+                        self.save_model_params(
+                            model=model,
+                            save_path=self.save_dir/f"step={step}-avg_miou={avg_miou:.4f}.pth",
+                        )
                     max_avg_miou = avg_miou
                 log = f"[ {step:,}/{self.n_steps:,} ]"
-                log += f"[ Average mIoU: {avg_miou:.4f} | {max_avg_miou:.4f} ]"
-                print(log)
+                log += f"[ mIoU: {avg_miou:.4f} | {max_avg_miou:.4f} ]"
+                log += f"[ Pixel acc.: {scores['pixel_acc']:.4f} ]"
+                log += f"[ FW IoU: {scores['fw_iou']:.4f} ]\n"
+                log += f"[ IoU by class: {scores['iou_by_cls']} ]"
+                if self.is_main:
+                    print(log)
 
 
 def main():
-    DEVICE = get_device()
-    print(f"[ DEVICE: {DEVICE} ]")
+    # Launch with `torchrun --nproc_per_node=N train.py ...` for data-parallel training.
+    RANK, WORLD_SIZE, DEVICE = init_dist()
+    if RANK == 0:
+        print(f"[ DEVICE: {DEVICE} ][ WORLD_SIZE: {WORLD_SIZE} ]")
     args = get_args()
-    set_seed(args.SEED)
+    if args.SYNC_BN and DEVICE.type != "cuda":
+        raise ValueError("`SyncBatchNorm` is only supported on GPUs.")
+    # The model is broadcast from rank 0 anyway, but `BatchAugmentation` should not draw the same
+    # numbers in every process.
+    set_seed(args.SEED + RANK)
 
-    model = ResNet101DeepLabv3(output_stride=16).to(DEVICE)
+    if args.RESUME_FROM is not None:
+        ckpt = torch.load(args.RESUME_FROM, map_location=DEVICE)
+        stage = ckpt.get("stage", 1)
+    else:
+        stage = args.STAGE
+        if stage == 2 and args.INIT_FROM is None:
+            raise ValueError("Stage 2 starts from a stage 1 checkpoint given by `--init_from`.")
+    if args.INIT_LR is None:
+        args.INIT_LR = 0.007 if stage == 1 else 0.001
+
+    if stage == 2 and args.RESUME_FROM is None:
+        # The keys of 'block3' are converted for `output_stride = 8`.
+        model = ResNet101DeepLabv3.from_checkpoint(args.INIT_FROM, output_stride=8)
+    else:
+        # The ImageNet weights would be overwritten by the checkpoint anyway.
+        model = ResNet101DeepLabv3(
+            output_stride=16 if stage == 1 else 8,
+            pretrained_backbone=args.RESUME_FROM is None,
+        )
+    if stage == 2:
+        # Also spares the memory batch normalization keeps for the backward pass.
+        model.freeze_bn()
+    model.set_activation_checkpointing(
+        block3_segments=args.CHECKPOINT_BLOCK3,
+        block4_segments=args.CHECKPOINT_BLOCK4,
+        aspp=args.CHECKPOINT_ASPP,
+    )
+    if args.SYNC_BN:
+        # Before creating the optimizer, as the batch normalization layers are replaced.
+        model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
+    model = model.to(DEVICE)
     # optim = SGD(
     #     params=model.parameters(),
     #     lr=args.INIT_LR,
     #     momentum=args.MOMENTUM,
     #     weight_decay=args.WEIGHT_DECAY,
     # )
-    optim = AdamW(params=model.parameters(), lr=args.INIT_LR)
+    # Without the frozen batch normalization parameters, which are buffers.
+    optim = AdamW(params=[param for param in model.parameters() if param.requires_grad], lr=args.INIT_LR)
     scaler = get_grad_scaler(device=DEVICE)
 
     if args.RESUME_FROM is not None:
-        ckpt = torch.load(args.RESUME_FROM, map_location=DEVICE)
         init_step = ckpt["step"]
         n_steps = ckpt["number_of_steps"]
         max_avg_miou = ckpt["maximum_average_mean_iou"]
@@ -237,31 +387,61 @@ def main():
         optim.load_state_dict(ckpt["optimizer"])
         if scaler is not None:
             scaler.load_state_dict(ckpt["scaler"])
-        print(f"Resume training from {init_step:,}/{n_steps:,} steps")
+        # Checkpoints saved before `InfiniteSampler` have neither the RNG states nor the sampler.
+        rng_states = ckpt.get("rng_states")
+        if rng_states is not None and len(rng_states) == WORLD_SIZE:
+            Trainer.set_rng_states(rng_states[RANK])
+        elif RANK == 0:
+            if rng_states is None:
+                print("[ The checkpoint has no RNG states. The current ones are used. ]")
+            else:
+                print("[ The number of processes has changed. The RNG states are not restored. ]")
+        if RANK == 0:
+            print(f"Resume training stage {stage} from {init_step:,}/{n_steps:,} steps")
     else:
         init_step = 0
         n_steps = args.N_STEPS
         max_avg_miou = 0
 
-    train_ds = VOC2012Dataset(img_dir=args.IMG_DIR, gt_dir=args.GT_DIR, split="train")
+    # The manifest (and the decoded cache, if any) is shared by all processes, so rank 0 builds it
+    # alone and the others read it once it has been written.
+    if RANK != 0:
+        dist.barrier()
+    train_ds = VOC2012Dataset(
+        img_dir=args.IMG_DIR, gt_dir=args.GT_DIR, split="train", decode_only=args.BATCH_AUG,
+    )
+    # Batches of images of similar shapes padded only as much as needed instead of `513 × 513`.
+    val_ds = VOC2012Dataset(img_dir=args.IMG_DIR, gt_dir=args.GT_DIR, split="val", pad_val=False)
+    if RANK == 0 and dist.is_initialized():
+        dist.barrier()
+    train_sampler = InfiniteSampler(len(train_ds), seed=args.SEED, rank=RANK, world_size=WORLD_SIZE)
+    if args.RESUME_FROM is not None:
+        if "sampler" in ckpt:
+            train_sampler.load_state_dict(ckpt["sampler"])
+        else:
+            train_sampler.start = init_step * args.BATCH_SIZE * args.GRAD_ACCUM_STEPS * WORLD_SIZE
+            if RANK == 0:
+                log = "[ The checkpoint has no sampler state. The data stream is resumed"
+                log += f" at sample {train_sampler.start:,}, assuming the current batch size. ]"
+                print(log)
     train_dl = DataLoader(
         train_ds,
         batch_size=args.BATCH_SIZE,
-        shuffle=True,
+        sampler=train_sampler,
         pin_memory=True,
-        drop_last=True,
         persistent_workers=True,
         num_workers=args.N_CPUS,
+        collate_fn=collate_uint8 if args.BATCH_AUG else None,
     )
-    val_ds = VOC2012Dataset(img_dir=args.IMG_DIR, gt_dir=args.GT_DIR, split="val")
     val_dl = DataLoader(
         val_ds,
-        batch_size=1,
-        shuffle=False,
+        batch_sampler=AspectRatioBucketSampler.from_dataset(
+            val_ds, batch_size=args.VAL_BATCH_SIZE, rank=RANK, world_size=WORLD_SIZE,
+        ),
         pin_memory=True,
-        drop_last=False,
         persistent_workers=True,
         num_workers=args.N_CPUS,
+        collate_fn=collate_padded,
     )
 
     trainer = Trainer(
@@ -271,7 +451,17 @@ def main():
         init_lr=args.INIT_LR,
         n_steps=n_steps,
         device=DEVICE,
+        batch_aug=BatchAugmentation(
+            img_size=train_ds.img_size, mean=train_ds.mean, std=train_ds.std,
+        ).to(DEVICE) if args.BATCH_AUG else None,
+        rank=RANK,
+        world_size=WORLD_SIZE,
+        grad_accum_steps=args.GRAD_ACCUM_STEPS,
+        stage=stage,
+        non_blocking=args.NON_BLOCKING,
     )
+    if dist.is_initialized():
+        model = DDP(model, device_ids=[DEVICE] if DEVICE.type == "cuda" else None)
     trainer.train(
         init_step=init_step,
         max_avg_miou=max_avg_miou,
@@ -282,6 +472,9 @@ def main():
         save_every=args.SAVE_EVERY,
         val_every=args.VAL_EVERY,
     )
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
 
 if __name__ == "__main__":
     main()
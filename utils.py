@@ -3,6 +3,7 @@
 
 from PIL import Image
 import torch
+import torch.distributed as dist
 import torchvision.transforms.functional as TF
 from torchvision.utils import make_grid
 from time import time
@@ -41,6 +42,9 @@ VOC_CLASS_COLOR = {
 VOC_CLASSES = list(VOC_CLASS_COLOR.keys())[: -1]
 N_CLASSES = len(VOC_CLASSES)
 VOC_COLORS = list(VOC_CLASS_COLOR.values())
+# Computed with `VOC2012Dataset.get_mean_and_std` on the 'trainaug' set.
+VOC_MEAN = (0.457, 0.437, 0.404)
+VOC_STD = (0.275, 0.271, 0.284)
 
 
 def get_device():
@@ -54,6 +58,27 @@ def get_device():
     return device
 
 
+def init_dist():
+    """
+    Initializes the default process group from the environment variables set by `torchrun`, with
+    'nccl' on GPUs and 'gloo' on CPUs, and returns the rank, the world size and the device of the
+    current process. Without `torchrun`, returns `(0, 1, get_device())`.
+    """
+    if "WORLD_SIZE" not in os.environ:
+        return 0, 1, get_device()
+
+    if torch.cuda.is_available():
+        local_rank = int(os.environ["LOCAL_RANK"])
+        torch.cuda.set_device(local_rank)
+        device = torch.device(f"cuda:{local_rank}")
+        backend = "nccl"
+    else:
+        device = torch.device("cpu")
+        backend = "gloo"
+    dist.init_process_group(backend=backend)
+    return dist.get_rank(), dist.get_world_size(), device
+
+
 def set_seed(seed):
     random.seed(seed)
     np.random.seed(seed)
@@ -3,8 +3,10 @@
     # https://www.dropbox.com/s/oeu149j8qtbs1x0/SegmentationClassAug.zip?dl=0&file_subpath=%2FSegmentationClassAug
 
 import torch
-from torch.utils.data import Dataset, DataLoader
-import torchvision.transforms as T
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.distributed as dist
+from torch.utils.data import Dataset, IterableDataset, DataLoader, get_worker_info
 import torchvision.transforms.functional as TF
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
@@ -12,117 +14,137 @@ import cv2
 from PIL import Image
 from pathlib import Path
 import random
+import json
+import tarfile
+import io
+import hashlib
+import math
+import os
+from queue import Queue, Full
+from threading import Thread, Event
+from concurrent.futures import ProcessPoolExecutor
+from statistics import NormalDist
 import numpy as np
 from tqdm import tqdm
 
-from utils import visualize_batched_image_and_gt
+from utils import VOC_MEAN, VOC_STD, visualize_batched_image_and_gt
 
 
-class VOC2012Dataset(Dataset):
-    # `get_mean_and_std`
+def _get_pixel_stats(img_paths):
+    """
+    Returns the number of pixels, the per-channel mean and the per-channel sum of squared
+    deviations from it over all the images (in float64), along with the per-image means.
+    """
+    stats = None
+    img_means = list()
+    for img_path in img_paths:
+        image = np.asarray(Image.open(img_path).convert("RGB"), dtype=np.float64).reshape(-1, 3) / 255
+        mean = image.mean(axis=0)
+        img_stats = (image.shape[0], mean, ((image - mean) ** 2).sum(axis=0))
+        stats = img_stats if stats is None else _merge_pixel_stats(stats, img_stats)
+        img_means.append(mean)
+    return stats, img_means
+
+
+def _merge_pixel_stats(stats1, stats2):
+    n1, mean1, m2_1 = stats1
+    n2, mean2, m2_2 = stats2
+    n = n1 + n2
+    delta = mean2 - mean1
+    return n, mean1 + delta * n2 / n, m2_1 + m2_2 + delta ** 2 * n1 * n2 / n
+
+
+class VOC2012Transform(object):
+    """
+    The preprocessing shared by `VOC2012Dataset` and `VOC2012ShardDataset`.
+    """
     def __init__(
         self,
-        img_dir,
-        gt_dir,
-        img_size=513,
-        mean=(0.457, 0.437, 0.404),
-        std=(0.275, 0.271, 0.284),
-        split="train",
+        img_size,
+        mean,
+        std,
+        split,
+        fused_aug=True,
+        decode_only=False,
+        draft_decode=True,
+        pad_val=True,
     ):
-        super().__init__()
+        """
+        If `decode_only=True`, the 'train' split is returned as `uint8` tensors of the original
+        size, to be collated by `collate_uint8` and augmented by `BatchAugmentation`.
 
-        self.img_dir = Path(img_dir)
-        self.gt_dir = Path(gt_dir)
+        If `draft_decode=True`, JPEG images which are going to be downscaled are decoded directly
+        at a reduced resolution (see `_decode`).
+
+        If `pad_val=False`, the 'val' split is not padded to `img_size × img_size` and has to be
+        batched with `collate_padded`.
+        """
         self.img_size = img_size
-        val_filenames = self.get_val_filenames()
-        if mean is None and std is None:
-            self.mean, self.std = self.get_mean_and_std(val_filenames)
-        else:
-            self.mean = mean
-            self.std = std
+        self.mean = mean
+        self.std = std
         self.split = split
-
-        self.gts = list(self.gt_dir.glob("*.png"))
-        if split == "train":
-            self.gts = [i for i in self.gts if i.stem not in val_filenames]
-        elif split == "val":
-            self.gts = [i for i in self.gts if i.stem in val_filenames]
+        self.fused_aug = fused_aug
+        self.decode_only = decode_only
+        self.draft_decode = draft_decode
+        self.pad_val = pad_val
 
         self.val_transform = self.get_val_transform(
-            img_size=img_size, mean=self.mean, std=self.std,
+            img_size=img_size, mean=self.mean, std=self.std, pad=pad_val,
         )
 
-    def get_val_filenames(self):
-        val_txt_path = self.img_dir.parent/"ImageSets/Segmentation/val.txt"
-        with open(val_txt_path, mode="r") as f:
-            filenames = [l.strip() for l in f.readlines()]
-        return filenames
-
-    def get_mean_and_std(self, val_filenames):
-        cnt = 0
-        sum_rgb = 0
-        sum_rgb_square = 0
-        sum_resol = 0
-        for gt_path in tqdm(list(self.gt_dir.glob("*.png"))):
-            if gt_path.stem in val_filenames:
-                continue
-            cnt += 1
-
-            img_path = (self.img_dir/gt_path.stem).with_suffix(".jpg")
-            pil_img = Image.open(img_path)
-            tensor = T.ToTensor()(pil_img)
-            
-            sum_rgb += tensor.sum(dim=(1, 2))
-            sum_rgb_square += (tensor ** 2).sum(dim=(1, 2))
-            _, h, w = tensor.shape
-            sum_resol += h * w
-        mean = torch.round(sum_rgb / sum_resol, decimals=3)
-        std = torch.round((sum_rgb_square / sum_resol - mean ** 2) ** 0.5, decimals=3)
-        print(f"""Total {cnt:,} images found.""")
-        return mean, std
-
     @classmethod
-    def get_val_transform(cls, img_size, mean, std):
-        return A.Compose(
-            [
-                A.LongestMaxSize(max_size=img_size, interpolation=cv2.INTER_AREA),
+    def get_val_transform(cls, img_size, mean, std, pad=True):
+        transforms = [A.LongestMaxSize(max_size=img_size, interpolation=cv2.INTER_AREA)]
+        if pad:
+            transforms.append(
                 A.PadIfNeeded(
                     min_height=img_size,
                     min_width=img_size,
                     border_mode=cv2.BORDER_CONSTANT,
                     value=tuple([int(i * 255) for i in mean]),
                 ),
-                A.Normalize(mean=mean, std=std),
-                ToTensorV2(),
-            ],
-        )
+            )
+        transforms.extend([A.Normalize(mean=mean, std=std), ToTensorV2()])
+        return A.Compose(transforms)
+
+    def _decode(self, image, size=None):
+        """
+        Decodes `image`, opened but not yet loaded. If `size` is given, a JPEG is decoded with the
+        smallest DCT scaling (1/8, 1/4 or 1/2) whose output is at least `size`, which leaves the
+        rest of the resize to the caller.
+        """
+        if not isinstance(image, Image.Image):
+            return image
+        if size is not None and self.draft_decode and image.format == "JPEG":
+            image.draft("RGB", size)
+        return image.convert("RGB")
 
-    def _randomly_adjust_b_and_s(self, image):
-        image = TF.adjust_brightness(image, random.uniform(0.5, 1.5))
-        image = TF.adjust_saturation(image, random.uniform(0.5, 1.5))
+    def _randomly_adjust_b_and_s(self, image, rng=random):
+        image = TF.adjust_brightness(image, rng.uniform(0.5, 1.5))
+        image = TF.adjust_saturation(image, rng.uniform(0.5, 1.5))
         return image
 
-    def _randomly_flip_horizontally(self, image, gt, p=0.5):
+    def _randomly_flip_horizontally(self, image, gt, p=0.5, rng=random):
         """
         "Randomly left-right flipping"
         """
-        if random.random() > 1 - p:
+        if rng.random() > 1 - p:
             image = TF.hflip(image)
             gt = TF.hflip(gt)
         return image, gt
 
-    def _randomly_scale(self, image, gt):
+    def _randomly_scale(self, image, gt, rng=random):
         """
         "We apply data augmentation by randomly scaling the input images (from 0.5 to 2.0)."
         """
         w, h = gt.size
-        scale = random.uniform(0.5, 2)
+        scale = rng.uniform(0.5, 2)
         size = (round(scale * h), round(scale * w))
         gt = TF.resize(gt, size=size, interpolation=Image.NEAREST)
         image = TF.resize(image, size=size)
         return image, gt
 
-    def _randomly_crop(self, image, gt):
+    def _randomly_crop(self, image, gt, gen=None):
         """
         "We employ crop size to be $513$ during both training and test on PASCAL VOC 2012
             dataset."
@@ -130,37 +152,685 @@ class VOC2012Dataset(Dataset):
         w, h = gt.size
         padding = (max(0, self.img_size - w), max(0, self.img_size - h))
         gt = TF.pad(gt, padding=padding, padding_mode="constant")
-        t, l, h, w = T.RandomCrop.get_params(img=gt, output_size=(self.img_size, self.img_size))
+        # As `T.RandomCrop.get_params`, but drawing from `gen`.
+        padded_w, padded_h = gt.size
+        t = torch.randint(0, padded_h - self.img_size + 1, size=(1,), generator=gen).item()
+        l = torch.randint(0, padded_w - self.img_size + 1, size=(1,), generator=gen).item()
+        h = w = self.img_size
         gt = TF.crop(gt, top=t, left=l, height=h, width=w)
 
         image = TF.pad(image, padding=padding, padding_mode="constant")
         image = TF.crop(image, top=t, left=l, height=h, width=w)
         return image, gt
 
-    def _transform(self, image, gt):
+    def _get_scale_flip_and_crop_params(self, w, h, rng=random):
+        scale = rng.uniform(0.5, 2)
+        scaled_w, scaled_h = round(scale * w), round(scale * h)
+        pad_w = max(0, self.img_size - scaled_w)
+        pad_h = max(0, self.img_size - scaled_h)
+        # Top left corner of the crop window in the scaled image, negative inside the padding.
+        left = rng.randint(0, scaled_w + 2 * pad_w - self.img_size) - pad_w
+        top = rng.randint(0, scaled_h + 2 * pad_h - self.img_size) - pad_h
+        flip = rng.random() < 0.5
+        return (scaled_w, scaled_h), (left, top), flip
+
+    def _scale_flip_and_crop(self, image, scaled_size, corner, flip, resample):
+        """
+        Resizes only the part of `image` which falls into the crop window, directly to its final
+        size, and pastes it on a black canvas. `image` may have any resolution as long as it has the
+        aspect ratio of the original.
+        """
+        scaled_w, scaled_h = scaled_size
+        left, top = corner
+        x0, y0 = max(left, 0), max(top, 0)
+        x1 = min(left + self.img_size, scaled_w)
+        y1 = min(top + self.img_size, scaled_h)
+        scale_x = image.width / scaled_w
+        scale_y = image.height / scaled_h
+        region = image.resize(
+            (x1 - x0, y1 - y0),
+            resample=resample,
+            box=(x0 * scale_x, y0 * scale_y, x1 * scale_x, y1 * scale_y),
+        )
+        canvas = Image.new(image.mode, (self.img_size, self.img_size))
+        canvas.paste(region, (x0 - left, y0 - top))
+        if flip:
+            canvas = canvas.transpose(Image.FLIP_LEFT_RIGHT)
+        return canvas
+
+    def _randomly_scale_flip_and_crop(self, image, gt, rng=random):
+        """
+        Same distribution as `_randomly_flip_horizontally`, `_randomly_scale` and `_randomly_crop`
+        applied one after the other, in a single resampling of the crop window. Since the padding
+        is symmetric and the crop window uniformly distributed, flipping the crop is the same as
+        cropping the flipped image.
+        """
+        w, h = gt.size
+        scaled_size, corner, flip = self._get_scale_flip_and_crop_params(w=w, h=h, rng=rng)
+        image = self._decode(image, size=scaled_size)
+        image = self._scale_flip_and_crop(
+            image, scaled_size=scaled_size, corner=corner, flip=flip, resample=Image.BILINEAR,
+        )
+        gt = self._scale_flip_and_crop(
+            gt, scaled_size=scaled_size, corner=corner, flip=flip, resample=Image.NEAREST,
+        )
+        return image, gt
+
+    def _transform(self, image, gt, rng=random, gen=None):
+        """
+        `image` is expected not to be loaded yet, so that it is decoded only at the resolution
+        needed. The augmentation draws from `rng` (a `random.Random`) and `gen` (a
+        `torch.Generator`), by default from the global generators.
+        """
+        if self.split == "train" and self.decode_only:
+            image = self._decode(image)
+            image = torch.from_numpy(np.array(image, dtype=np.uint8)).permute(2, 0, 1)
+            gt = torch.from_numpy(np.array(gt, dtype=np.uint8))[None, ...]
+            return image, gt
+
         if self.split == "train":
-            image = self._randomly_adjust_b_and_s(image)
-            image, gt = self._randomly_flip_horizontally(image=image, gt=gt)
-            image, gt = self._randomly_scale(image=image, gt=gt)
-            image, gt = self._randomly_crop(image=image, gt=gt)
+            if self.fused_aug:
+                image, gt = self._randomly_scale_flip_and_crop(image=image, gt=gt, rng=rng)
+                # Brightness and saturation are adjusted pixel-wise, so only the crop needs to be.
+                image = self._randomly_adjust_b_and_s(image, rng=rng)
+            else:
+                image = self._decode(image)
+                image = self._randomly_adjust_b_and_s(image, rng=rng)
+                image, gt = self._randomly_flip_horizontally(image=image, gt=gt, rng=rng)
+                image, gt = self._randomly_scale(image=image, gt=gt, rng=rng)
+                image, gt = self._randomly_crop(image=image, gt=gt, gen=gen)
             image = TF.to_tensor(image)
             image = TF.normalize(image, mean=self.mean, std=self.std)
             gt = TF.pil_to_tensor(gt)
 
         elif self.split == "val":
-            transformed = self.val_transform(image=np.array(image), mask=np.array(gt))
+            gt = np.asarray(gt)
+            h, w = gt.shape
+            scale = self.img_size / max(w, h)
+            size = (round(w * scale), round(h * scale))
+            image = np.asarray(self._decode(image, size=size))
+            if image.shape[: 2] != gt.shape:
+                # Finishes the resize of `LongestMaxSize` from the reduced resolution.
+                image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+                gt = cv2.resize(gt, size, interpolation=cv2.INTER_NEAREST)
+            transformed = self.val_transform(image=image, mask=gt)
             image = transformed["image"]
             gt = transformed["mask"][None, ...]
         return image, gt.long()
 
+
+class VOC2012Dataset(VOC2012Transform, Dataset):
+    # `get_mean_and_std`
+    def __init__(
+        self,
+        img_dir,
+        gt_dir,
+        img_size=513,
+        mean=VOC_MEAN,
+        std=VOC_STD,
+        split="train",
+        manifest_path=None,
+        rebuild_manifest=False,
+        decoded_cache_dir=None,
+        fused_aug=True,
+        decode_only=False,
+        draft_decode=True,
+        pad_val=True,
+    ):
+        """
+        The files are listed from a manifest which is built on the first use and then stored at
+        `manifest_path` (by default next to `gt_dir`), so that creating a dataset does not scan
+        `gt_dir`.
+
+        If `decoded_cache_dir` is given, the images and the ground truths are decoded once into
+        memory-mapped files there (see `build_decoded_cache`) and read from them afterwards.
+        """
+        self.img_dir = Path(img_dir)
+        self.gt_dir = Path(gt_dir)
+
+        if manifest_path is None:
+            manifest_path = self.gt_dir.parent/f"{self.gt_dir.name}_manifest.json"
+        self.manifest_path = Path(manifest_path)
+        self.manifest = self.get_manifest(rebuild=rebuild_manifest)
+        if mean is None and std is None:
+            mean, std = self.get_mean_and_std()
+        super().__init__(
+            img_size=img_size,
+            mean=mean,
+            std=std,
+            split=split,
+            fused_aug=fused_aug,
+            decode_only=decode_only,
+            draft_decode=draft_decode,
+            pad_val=pad_val,
+        )
+
+        self.manifest_indices = [
+            idx for idx, sample in enumerate(self.manifest["samples"]) if sample["split"] == split
+        ]
+        self.samples = [self.manifest["samples"][idx] for idx in self.manifest_indices]
+        self.gts = [self.gt_dir/f"{sample['stem']}.png" for sample in self.samples]
+
+        self.decoded_cache_dir = decoded_cache_dir
+        if decoded_cache_dir is not None:
+            self.decoded_cache_dir = Path(decoded_cache_dir)
+            if not self.is_decoded_cache_valid(self.decoded_cache_dir):
+                self.build_decoded_cache(self.decoded_cache_dir)
+        # Opened lazily in each worker.
+        self._decoded_cache = None
+
+    def get_val_filenames(self):
+        val_txt_path = self.img_dir.parent/"ImageSets/Segmentation/val.txt"
+        with open(val_txt_path, mode="r") as f:
+            filenames = {l.strip() for l in f.readlines()}
+        return filenames
+
+    def build_manifest(self):
+        """
+        Lists every image-ground truth pair along with its size, its split ('val' if it is in the
+        official validation set, 'train' otherwise) and the classes present in the ground truth.
+        """
+        val_filenames = self.get_val_filenames()
+        samples = list()
+        for gt_path in tqdm(sorted(self.gt_dir.glob("*.png")), desc="Building manifest..."):
+            gt = np.array(Image.open(gt_path))
+            h, w = gt.shape
+            classes = np.unique(gt)
+            samples.append(
+                {
+                    "stem": gt_path.stem,
+                    "height": h,
+                    "width": w,
+                    "split": "val" if gt_path.stem in val_filenames else "train",
+                    "classes": [int(c) for c in classes if c != 255],
+                }
+            )
+        return {"samples": samples}
+
+    def get_manifest(self, rebuild=False):
+        if self.manifest_path.exists() and not rebuild:
+            with open(self.manifest_path, mode="r") as f:
+                return json.load(f)
+
+        manifest = self.build_manifest()
+        self.save_manifest(manifest)
+        return manifest
+
+    def save_manifest(self, manifest):
+        # Written to a temporary file next to the manifest and then renamed, so that an
+        # interrupted write never leaves a truncated manifest behind.
+        tmp_path = self.manifest_path.with_name(f"{self.manifest_path.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp_path, mode="w") as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, self.manifest_path)
+        except OSError:
+            print(f"Failed to save the manifest to '{self.manifest_path}'.")
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    def get_decoded_cache_meta(self):
+        """
+        Identifies the manifest a decoded cache was built from, since the cache is indexed by the
+        position of the samples in the manifest.
+        """
+        stems = [sample["stem"] for sample in self.manifest["samples"]]
+        return {
+            "n_samples": len(stems),
+            "stems_sha1": hashlib.sha1("\n".join(stems).encode()).hexdigest(),
+        }
+
+    def is_decoded_cache_valid(self, cache_dir):
+        cache_dir = Path(cache_dir)
+        if not (cache_dir/"index.npy").exists() or not (cache_dir/"meta.json").exists():
+            return False
+        with open(cache_dir/"meta.json", mode="r") as f:
+            meta = json.load(f)
+        if meta != self.get_decoded_cache_meta():
+            print(f"The decoded cache at '{cache_dir}' does not match the manifest. Rebuilding it.")
+            return False
+        return True
+
+    def build_decoded_cache(self, cache_dir):
+        """
+        Writes every decoded image (`(h, w, 3)`) and ground truth (`(h, w)`) of the manifest,
+        both splits included, back to back into 'images.bin' and 'gts.bin' as `uint8`, along with
+        'index.npy' which holds the offsets and the size of each sample, in the manifest order,
+        and 'meta.json' which identifies the manifest (see `get_decoded_cache_meta`).
+        """
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        # Removed first so that the cache is not used until it is complete.
+        (cache_dir/"index.npy").unlink(missing_ok=True)
+        samples = self.manifest["samples"]
+        index = np.zeros((len(samples), 4), dtype=np.int64)
+        img_offset = 0
+        gt_offset = 0
+        with open(cache_dir/"images.bin", mode="wb") as img_f, open(cache_dir/"gts.bin", mode="wb") as gt_f:
+            for idx, sample in enumerate(tqdm(samples, desc="Decoding...")):
+                image = np.asarray(
+                    Image.open(f"{self.img_dir/sample['stem']}.jpg").convert("RGB"), dtype=np.uint8,
+                )
+                gt = np.asarray(Image.open(self.gt_dir/f"{sample['stem']}.png"), dtype=np.uint8)
+                h, w = gt.shape
+                img_f.write(image.tobytes())
+                gt_f.write(gt.tobytes())
+                index[idx] = (img_offset, gt_offset, h, w)
+                img_offset += h * w * 3
+                gt_offset += h * w
+        with open(cache_dir/"meta.json", mode="w") as f:
+            json.dump(self.get_decoded_cache_meta(), f)
+        # Written last so that an interrupted run is rebuilt.
+        np.save(cache_dir/"index.npy", index)
+
+    def _read_decoded(self, idx):
+        """
+        Returns read-only views of the memory-mapped image and ground truth.
+        """
+        if self._decoded_cache is None:
+            self._decoded_cache = (
+                np.memmap(self.decoded_cache_dir/"images.bin", dtype=np.uint8, mode="r"),
+                np.memmap(self.decoded_cache_dir/"gts.bin", dtype=np.uint8, mode="r"),
+                np.load(self.decoded_cache_dir/"index.npy"),
+            )
+        images, gts, index = self._decoded_cache
+        img_offset, gt_offset, h, w = index[self.manifest_indices[idx]]
+        image = images[img_offset: img_offset + h * w * 3].reshape(h, w, 3)
+        gt = gts[gt_offset: gt_offset + h * w].reshape(h, w)
+        return image, gt
+
+    def __getstate__(self):
+        # `np.memmap`s would be pickled as copies of the whole files.
+        state = self.__dict__.copy()
+        state["_decoded_cache"] = None
+        return state
+
+    def write_shards(self, shard_dir, samples_per_shard=1000):
+        """
+        Packs the still-encoded image-ground truth pairs of this split into tar shards of
+        `samples_per_shard` pairs each, to be read sequentially by `VOC2012ShardDataset`.
+        """
+        shard_dir = Path(shard_dir)
+        shard_dir.mkdir(parents=True, exist_ok=True)
+        shards = list()
+        for shard_idx, start in enumerate(range(0, len(self.gts), samples_per_shard)):
+            gt_paths = self.gts[start: start + samples_per_shard]
+            name = f"{self.split}-{shard_idx:05d}.tar"
+            with tarfile.open(shard_dir/name, mode="w") as tar:
+                for gt_path in tqdm(gt_paths, desc=f"Writing {name}..."):
+                    tar.add(f"{self.img_dir/gt_path.stem}.jpg", arcname=f"{gt_path.stem}.jpg")
+                    tar.add(gt_path, arcname=f"{gt_path.stem}.png")
+            shards.append({"name": name, "n_samples": len(gt_paths)})
+        with open(shard_dir/f"{self.split}-index.json", mode="w") as f:
+            json.dump({"shards": shards}, f)
+
+    def get_mean_and_std(self, n_samples=None, n_workers=None, confidence=0.95, seed=0):
+        """
+        Computes the per-channel pixel mean and standard deviation of the 'train' split with a
+        pool of `n_workers` processes, each of which merges the float64 statistics of its images
+        (Chan et al.'s parallel variant of Welford's algorithm).
+
+        If `n_samples` is given, only that many randomly sampled images are used and the
+        half-width of the `confidence` interval on the mean is printed. The result is stored in
+        the manifest, keyed by the list of images used and, for a sample, by `n_samples` and
+        `seed`, so it is computed only once.
+        """
+        stems = [sample["stem"] for sample in self.manifest["samples"] if sample["split"] == "train"]
+        if n_samples is not None and n_samples < 1:
+            raise ValueError(f"`n_samples` must be at least 1, got {n_samples}.")
+        if not stems:
+            raise ValueError("The manifest has no 'train' images.")
+        if n_samples is not None and n_samples < len(stems):
+            stems = random.Random(seed).sample(stems, k=n_samples)
+        else:
+            # The whole split, whatever `n_samples` and `seed`.
+            n_samples = None
+            seed = None
+        key_str = "\n".join(stems)
+        if n_samples is not None:
+            key_str = f"n_samples={n_samples}\nseed={seed}\n{key_str}"
+        key = hashlib.sha1(key_str.encode()).hexdigest()
+        cache = self.manifest.setdefault("mean_and_std", dict())
+        if key in cache:
+            return tuple(cache[key]["mean"]), tuple(cache[key]["std"])
+
+        img_paths = [f"{self.img_dir/stem}.jpg" for stem in stems]
+        n_workers = n_workers or os.cpu_count()
+        chunk_size = max(1, math.ceil(len(img_paths) / (n_workers * 4)))
+        chunks = [img_paths[idx: idx + chunk_size] for idx in range(0, len(img_paths), chunk_size)]
+        stats = None
+        img_means = list()
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            for chunk_stats, chunk_img_means in tqdm(
+                executor.map(_get_pixel_stats, chunks), total=len(chunks), desc="Computing mean and std...",
+            ):
+                stats = chunk_stats if stats is None else _merge_pixel_stats(stats, chunk_stats)
+                img_means.extend(chunk_img_means)
+        _, mean, m2 = stats
+        std = np.sqrt(m2 / stats[0])
+        print(f"""Total {len(stems):,} images used.""")
+
+        if n_samples is not None:
+            # The images are the sampling units. Finite population correction included.
+            n_total = sum([sample["split"] == "train" for sample in self.manifest["samples"]])
+            fpc = math.sqrt(max(0, 1 - len(stems) / n_total))
+            z = NormalDist().inv_cdf((1 + confidence) / 2)
+            half_width = z * np.std(img_means, axis=0, ddof=1) / math.sqrt(len(stems)) * fpc
+            print(f"""{confidence:.0%} confidence interval on the mean: ± {np.round(half_width, 4).tolist()}""")
+
+        mean = tuple(np.round(mean, 3).tolist())
+        std = tuple(np.round(std, 3).tolist())
+        cache[key] = {"mean": mean, "std": std, "n_samples": n_samples, "seed": seed}
+        self.save_manifest(self.manifest)
+        return mean, std
+
     def __len__(self):
         return len(self.gts)
 
     def __getitem__(self, idx):
-        gt_path = self.gts[idx]
-        gt = Image.open(gt_path)
-        image = Image.open(f"{self.img_dir/gt_path.stem}.jpg").convert("RGB")
-        image, gt = self._transform(image=image, gt=gt)
+        """
+        `idx` may also be an `(idx, seed)` pair from `InfiniteSampler`, in which case the
+        augmentation draws from generators of its own seeded with `seed`, leaving the global ones
+        (which the training loop uses and checkpoints) untouched.
+        """
+        rng = random
+        gen = None
+        if isinstance(idx, (tuple, list)):
+            idx, seed = idx
+            rng = random.Random(seed)
+            gen = torch.Generator().manual_seed(seed)
+
+        if self.decoded_cache_dir is not None:
+            image, gt = self._read_decoded(idx)
+            if self.split == "train":
+                image = Image.fromarray(image)
+                gt = Image.fromarray(gt)
+        else:
+            gt_path = self.gts[idx]
+            gt = Image.open(gt_path)
+            image = Image.open(f"{self.img_dir/gt_path.stem}.jpg")
+        image, gt = self._transform(image=image, gt=gt, rng=rng, gen=gen)
+        return image, gt
+
+
+class VOC2012ShardDataset(VOC2012Transform, IterableDataset):
+    """
+    Streams the shards written by `VOC2012Dataset.write_shards` and yields the same `(image, gt)`
+    pairs as `VOC2012Dataset.__getitem__`.
+
+    The shards are split across the processes and then across the `DataLoader` workers of each
+    process, so every sample is yielded once per epoch provided that there are at least as many
+    shards as workers in total, and `len` is the number of samples of the current process. Each worker reads whole shards ahead in a background thread, and
+    for the 'train' split shuffles the shard order and the samples within a buffer of
+    `shuffle_buffer` samples. Call `set_epoch` before each epoch to change the shuffling.
+    """
+    def __init__(
+        self,
+        shard_dir,
+        img_size=513,
+        mean=VOC_MEAN,
+        std=VOC_STD,
+        split="train",
+        shuffle_buffer=1000,
+        n_prefetch_shards=2,
+        seed=0,
+        fused_aug=True,
+        decode_only=False,
+        draft_decode=True,
+        pad_val=True,
+    ):
+        super().__init__(
+            img_size=img_size,
+            mean=mean,
+            std=std,
+            split=split,
+            fused_aug=fused_aug,
+            decode_only=decode_only,
+            draft_decode=draft_decode,
+            pad_val=pad_val,
+        )
+
+        self.shard_dir = Path(shard_dir)
+        with open(self.shard_dir/f"{split}-index.json", mode="r") as f:
+            self.shards = json.load(f)["shards"]
+        self.shuffle_buffer = shuffle_buffer
+        self.n_prefetch_shards = n_prefetch_shards
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        names = set(self._get_rank_shard_names(random.Random(self.seed + self.epoch)))
+        return sum([shard["n_samples"] for shard in self.shards if shard["name"] in names])
+
+    @staticmethod
+    def _get_rank_and_world_size():
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+        return 0, 1
+
+    @staticmethod
+    def _get_worker_id_and_n_workers():
+        worker_info = get_worker_info()
+        if worker_info is None:
+            return 0, 1
+        return worker_info.id, worker_info.num_workers
+
+    def _get_rank_shard_names(self, rng):
+        names = [shard["name"] for shard in self.shards]
+        if self.split == "train":
+            # Every process and worker draws the same order from `rng` before taking its own share.
+            rng.shuffle(names)
+        rank, world_size = self._get_rank_and_world_size()
+        return names[rank:: world_size]
+
+    def _get_shard_names(self, rng):
+        worker_id, n_workers = self._get_worker_id_and_n_workers()
+        return self._get_rank_shard_names(rng)[worker_id:: n_workers]
+
+    def _read_shards(self, names, queue, stop):
+        for name in names + [None]:
+            if name is None:
+                shard = None
+            else:
+                with open(self.shard_dir/name, mode="rb") as f:
+                    shard = f.read()
+            # Gives up as soon as the consumer has stopped, instead of blocking on a full queue.
+            while not stop.is_set():
+                try:
+                    queue.put(shard, timeout=0.1)
+                    break
+                except Full:
+                    pass
+            if stop.is_set():
+                return
+
+    def _iter_samples(self, names):
+        queue = Queue(maxsize=self.n_prefetch_shards)
+        stop = Event()
+        thread = Thread(target=self._read_shards, args=(names, queue, stop), daemon=True)
+        thread.start()
+        # Also run when the consumer stops early, e.g., with `break`, and the generator is closed.
+        try:
+            while True:
+                shard = queue.get()
+                if shard is None:
+                    break
+
+                with tarfile.open(fileobj=io.BytesIO(shard), mode="r") as tar:
+                    files = dict()
+                    for member in tar.getmembers():
+                        stem, ext = member.name.rsplit(".", 1)
+                        files.setdefault(stem, dict())[ext] = tar.extractfile(member).read()
+                for stem in files:
+                    yield files[stem]["jpg"], files[stem]["png"]
+        finally:
+            stop.set()
+            thread.join()
+
+    def _decode_and_transform(self, img_bytes, gt_bytes):
+        image = Image.open(io.BytesIO(img_bytes))
+        gt = Image.open(io.BytesIO(gt_bytes))
+        return self._transform(image=image, gt=gt)
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        names = self._get_shard_names(rng)
+        rank, _ = self._get_rank_and_world_size()
+        worker_id, n_workers = self._get_worker_id_and_n_workers()
+        worker_rng = random.Random(rng.randrange(2 ** 32) + rank * n_workers + worker_id)
+
+        # The shuffle buffer holds the encoded files, which are much smaller than the tensors.
+        buffer = list()
+        samples = self._iter_samples(names)
+        try:
+            for img_bytes, gt_bytes in samples:
+                if self.split != "train":
+                    yield self._decode_and_transform(img_bytes=img_bytes, gt_bytes=gt_bytes)
+                    continue
+
+                buffer.append((img_bytes, gt_bytes))
+                if len(buffer) >= self.shuffle_buffer:
+                    idx = worker_rng.randrange(len(buffer))
+                    buffer[idx], buffer[-1] = buffer[-1], buffer[idx]
+                    yield self._decode_and_transform(*buffer.pop())
+        finally:
+            # Stops the prefetching thread right away if this generator is closed early.
+            samples.close()
+        worker_rng.shuffle(buffer)
+        for img_bytes, gt_bytes in buffer:
+            yield self._decode_and_transform(img_bytes=img_bytes, gt_bytes=gt_bytes)
+
+
+def collate_padded(batch, output_stride=16, ignore_index=255):
+    """
+    Pads the normalized images and the ground truths of `VOC2012Transform(pad_val=False)` at the
+    bottom and the right to the smallest size of the form `k × output_stride + 1` (like 513) which
+    fits every image in the batch. The images are padded with zeros, i.e., with the mean color,
+    and the ground truths with `ignore_index`, so the padding is left out of the loss and of
+    `ConfusionMatrix`.
+    """
+    max_h = max([image.size(1) for image, _ in batch])
+    max_w = max([image.size(2) for image, _ in batch])
+    pad_h = math.ceil((max_h - 1) / output_stride) * output_stride + 1
+    pad_w = math.ceil((max_w - 1) / output_stride) * output_stride + 1
+    images = torch.zeros((len(batch), 3, pad_h, pad_w), dtype=batch[0][0].dtype)
+    gts = torch.full((len(batch), 1, pad_h, pad_w), ignore_index, dtype=batch[0][1].dtype)
+    for idx, (image, gt) in enumerate(batch):
+        _, h, w = image.shape
+        images[idx, :, : h, : w] = image
+        gts[idx, :, : h, : w] = gt
+    return images, gts
+
+
+def collate_uint8(batch):
+    """
+    Pads the `uint8` images and ground truths of `VOC2012Transform(decode_only=True)` with zeros
+    to the largest height and width in the batch.
+
+    Returns:
+        `(b, 3, h, w)` images, `(b, 1, h, w)` ground truths and `(b, 2)` original sizes
+    """
+    max_h = max([image.size(1) for image, _ in batch])
+    max_w = max([image.size(2) for image, _ in batch])
+    images = torch.zeros((len(batch), 3, max_h, max_w), dtype=torch.uint8)
+    gts = torch.zeros((len(batch), 1, max_h, max_w), dtype=torch.uint8)
+    sizes = torch.zeros((len(batch), 2), dtype=torch.long)
+    for idx, (image, gt) in enumerate(batch):
+        _, h, w = image.shape
+        images[idx, :, : h, : w] = image
+        gts[idx, :, : h, : w] = gt
+        sizes[idx] = torch.tensor([h, w])
+    return images, gts, sizes
+
+
+class BatchAugmentation(nn.Module):
+    """
+    The train augmentation of `VOC2012Transform` run on a whole collated batch at once, on the
+    device the batch is on: random scaling, padding, cropping and left-right flipping in a single
+    `F.grid_sample`, followed by brightness and saturation adjustment and normalization.
+
+    Unlike PIL's resizing, `F.grid_sample` does not antialias when scaling down.
+    """
+    def __init__(self, img_size=513, mean=VOC_MEAN, std=VOC_STD):
+        super().__init__()
+
+        self.img_size = img_size
+        self.register_buffer("mean", torch.tensor(mean)[None, :, None, None], persistent=False)
+        self.register_buffer("std", torch.tensor(std)[None, :, None, None], persistent=False)
+        # The coefficients of `TF.rgb_to_grayscale`.
+        self.register_buffer(
+            "gray_coeffs", torch.tensor([0.2989, 0.587, 0.114])[None, :, None, None], persistent=False,
+        )
+
+    def _get_src_coords(self, size, scaled_size, corner, flip):
+        """
+        Returns the source pixel coordinates each output pixel is sampled from along one axis, as
+        `(b, img_size)`, and whether they fall inside the scaled image.
+        """
+        coords = torch.arange(self.img_size, device=size.device, dtype=torch.float32)
+        coords = coords[None, :].expand(size.size(0), -1)
+        if flip is not None:
+            coords = torch.where(flip[:, None], self.img_size - 1 - coords, coords)
+        # Position of the pixel centers in the scaled image.
+        scaled_coords = corner[:, None] + coords + 0.5
+        valid = (scaled_coords >= 0) & (scaled_coords < scaled_size[:, None])
+        src_coords = scaled_coords * (size / scaled_size)[:, None]
+        src_coords = torch.minimum(src_coords.clamp(min=0.5), size[:, None] - 0.5)
+        return src_coords, valid
+
+    @torch.no_grad()
+    def forward(self, image, gt, sizes):
+        """
+        Args:
+            image: `(b, 3, h, w)` (dtype: `torch.uint8`)
+            gt: `(b, 1, h, w)` (dtype: `torch.uint8`)
+            sizes: `(b, 2)`, the heights and the widths before padding
+        Returns:
+            `(b, 3, img_size, img_size)` normalized images and `(b, 1, img_size, img_size)`
+            ground truths (dtype: `torch.long`)
+        """
+        b, _, max_h, max_w = image.shape
+        device = image.device
+        h = sizes[:, 0].float()
+        w = sizes[:, 1].float()
+
+        scale = torch.empty(b, device=device).uniform_(0.5, 2)
+        scaled_h = torch.round(scale * h)
+        scaled_w = torch.round(scale * w)
+        pad_h = (self.img_size - scaled_h).clamp(min=0)
+        pad_w = (self.img_size - scaled_w).clamp(min=0)
+        top = torch.floor(torch.rand(b, device=device) * (scaled_h + 2 * pad_h - self.img_size + 1)) - pad_h
+        left = torch.floor(torch.rand(b, device=device) * (scaled_w + 2 * pad_w - self.img_size + 1)) - pad_w
+        flip = torch.rand(b, device=device) < 0.5
+
+        src_y, valid_y = self._get_src_coords(size=h, scaled_size=scaled_h, corner=top, flip=None)
+        src_x, valid_x = self._get_src_coords(size=w, scaled_size=scaled_w, corner=left, flip=flip)
+        grid = torch.stack(
+            [
+                (2 * src_x / max_w - 1)[:, None, :].expand(-1, self.img_size, -1),
+                (2 * src_y / max_h - 1)[:, :, None].expand(-1, -1, self.img_size),
+            ],
+            dim=3,
+        ) # `(b, img_size, img_size, 2)`
+        valid = (valid_y[:, :, None] & valid_x[:, None, :])[:, None] # `(b, 1, img_size, img_size)`
+
+        image = F.grid_sample(image.float() / 255, grid, mode="bilinear", align_corners=False)
+        # The pixels outside the scaled image are 0 in both the image (black, before the
+        # normalization) and the ground truth, as with `TF.pad` in `VOC2012Transform`.
+        image = image * valid
+        gt = F.grid_sample(gt.float(), grid, mode="nearest", align_corners=False)
+        gt = (gt * valid).long()
+
+        brightness = torch.empty((b, 1, 1, 1), device=device).uniform_(0.5, 1.5)
+        image = (image * brightness).clamp(0, 1)
+        saturation = torch.empty((b, 1, 1, 1), device=device).uniform_(0.5, 1.5)
+        gray = (image * self.gray_coeffs).sum(dim=1, keepdim=True)
+        image = (saturation * image + (1 - saturation) * gray).clamp(0, 1)
+
+        image = (image - self.mean) / self.std
         return image, gt
 
 